@@ -0,0 +1,508 @@
+#
+# Spatial indexes over GeoJSON-ordered ([lon, lat]) coordinates.
+#
+# Distances here are in meters on a local equirectangular projection
+# around the query point, which is plenty accurate at the scale of a
+# track segment.
+#
+
+import math
+import heapq
+
+EARTH_RADIUS_M = 6.3781e6
+M_PER_DEG = EARTH_RADIUS_M * math.pi / 180
+
+# Cell edge in multiples of the mean segment extent
+CELL_SEGMENTS = 4
+
+# Smallest allowed cell edge, degrees (about 10 meters)
+MIN_CELL_DEG = 1e-4
+
+def lldist(lat1, lon1, lat2, lon2):
+    """
+    Return the great circle distance in meters between two points,
+    given lat, lon first, unlike the rest of this module.
+    """
+
+    R = EARTH_RADIUS_M
+
+    a1 = lat1 * math.pi/180;
+    a2 = lat2 * math.pi/180;
+    d1 = (lat2-lat1) * math.pi/180;
+    d2 = (lon2-lon1) * math.pi/180;
+
+    a = math.sin(d1/2)**2 + \
+        math.cos(a1) * math.cos(a2) * \
+        math.sin(d2/2)**2;
+
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a));
+
+    d = R * c
+
+    return d  # meters
+
+def dist_point_segment(lon, lat, a, b):
+    """
+    Return (distance in meters, t) from the point to the segment a-b,
+    where t in [0, 1] is the position of the closest point along the
+    segment.
+    """
+
+    kx = math.cos(math.radians(lat)) * M_PER_DEG
+
+    ax = (a[0] - lon) * kx
+    ay = (a[1] - lat) * M_PER_DEG
+    bx = (b[0] - lon) * kx
+    by = (b[1] - lat) * M_PER_DEG
+
+    dx = bx - ax
+    dy = by - ay
+
+    len2 = dx * dx + dy * dy
+
+    if len2 == 0:
+        t = 0.0
+    else:
+        t = -(ax * dx + ay * dy) / len2
+        t = min(1.0, max(0.0, t))
+
+    px = ax + t * dx
+    py = ay + t * dy
+
+    return math.sqrt(px * px + py * py), t
+
+class SegmentGrid:
+    """
+    Uniform grid over the segments of a list of polylines.
+
+    Each segment is bucketed into every cell its bounding box touches.
+    Segments are referred to as (line index, segment index), where
+    segment i runs from coordinate i to coordinate i+1 of the line.
+    """
+
+    def __init__(self, lines, cell_deg=None):
+        self.lines = lines
+        self.cells = {}
+
+        if cell_deg is None:
+            cell_deg = self.pick_cell_size(lines)
+
+        self.cell_deg = cell_deg
+        self.bounds = None
+
+        for li, coords in enumerate(lines):
+            for si in range(len(coords) - 1):
+                self.add_segment(li, si, coords[si], coords[si + 1])
+
+    @staticmethod
+    def pick_cell_size(lines):
+        total = 0
+        count = 0
+
+        for coords in lines:
+            for a, b in zip(coords, coords[1:]):
+                total += max(abs(b[0] - a[0]), abs(b[1] - a[1]))
+                count += 1
+
+        if count == 0:
+            return MIN_CELL_DEG
+
+        return max(MIN_CELL_DEG, total / count * CELL_SEGMENTS)
+
+    def cell(self, lon, lat):
+        return (math.floor(lon / self.cell_deg), math.floor(lat / self.cell_deg))
+
+    def add_segment(self, li, si, a, b):
+        x0, y0 = self.cell(min(a[0], b[0]), min(a[1], b[1]))
+        x1, y1 = self.cell(max(a[0], b[0]), max(a[1], b[1]))
+
+        if self.bounds is None:
+            self.bounds = [x0, y0, x1, y1]
+        else:
+            bd = self.bounds
+            bd[0] = min(bd[0], x0)
+            bd[1] = min(bd[1], y0)
+            bd[2] = max(bd[2], x1)
+            bd[3] = max(bd[3], y1)
+
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                self.cells.setdefault((x, y), []).append((li, si))
+
+    def ring(self, cx, cy, r):
+        """
+        Yield the cell keys on the square ring r cells out from (cx, cy).
+        """
+
+        if r == 0:
+            yield (cx, cy)
+            return
+
+        for x in range(cx - r, cx + r + 1):
+            yield (x, cy - r)
+            yield (x, cy + r)
+
+        for y in range(cy - r + 1, cy + r):
+            yield (cx - r, y)
+            yield (cx + r, y)
+
+    def segments_in(self, extent):
+        """
+        Return the set of segments in the cells the extent touches, a
+        superset of the segments whose bounding boxes it intersects.
+        """
+
+        if self.bounds is None:
+            return set()
+
+        x0, y0 = self.cell(extent[0], extent[1])
+        x1, y1 = self.cell(extent[2], extent[3])
+
+        bx0, by0, bx1, by1 = self.bounds
+        x0, y0, x1, y1 = max(x0, bx0), max(y0, by0), min(x1, bx1), min(y1, by1)
+
+        segs = set()
+
+        if x0 > x1 or y0 > y1:
+            return segs
+
+        # Walk whichever is fewer, the cells in range or the filled ones
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self.cells):
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    segs.update(self.cells.get((x, y), ()))
+        else:
+            for (x, y), cell_segs in self.cells.items():
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    segs.update(cell_segs)
+
+        return segs
+
+    def nearest(self, lon, lat, max_dist=math.inf):
+        """
+        Return (distance in meters, line index, segment index, t) of the
+        segment closest to the point, or None if there isn't one within
+        max_dist.
+        """
+
+        if self.bounds is None:
+            return None
+
+        cx, cy = self.cell(lon, lat)
+        bx0, by0, bx1, by1 = self.bounds
+
+        # Cell size in meters, and where the point sits in its cell
+        cell_x_m = self.cell_deg * M_PER_DEG * math.cos(math.radians(lat))
+        cell_y_m = self.cell_deg * M_PER_DEG
+        fx = lon / self.cell_deg - cx
+        fy = lat / self.cell_deg - cy
+
+        # Rings r and beyond are at least this far away, plus r-1 cells
+        edge_m = min(min(fx, 1 - fx) * cell_x_m, min(fy, 1 - fy) * cell_y_m)
+        ring_m = min(cell_x_m, cell_y_m)
+
+        # Beyond this ring we've covered the whole grid
+        max_r = max(cx - bx0, bx1 - cx, cy - by0, by1 - cy, 0)
+
+        best = None
+        best_dist = max_dist
+        seen = set()
+
+        r = 0
+
+        while r <= max_r:
+            if r > 0 and edge_m + (r - 1) * ring_m >= best_dist:
+                break
+
+            for key in self.ring(cx, cy, r):
+                for seg in self.cells.get(key, ()):
+                    if seg in seen:
+                        continue
+
+                    seen.add(seg)
+
+                    li, si = seg
+                    coords = self.lines[li]
+
+                    d, t = dist_point_segment(lon, lat, coords[si], coords[si + 1])
+
+                    if d < best_dist:
+                        best_dist = d
+                        best = (d, li, si, t)
+
+            r += 1
+
+        return best
+
+def parse_bbox(s):
+    """
+    Parse a "west,south,east,north" string into an extent list. Raise
+    ValueError if it isn't one.
+    """
+
+    extent = [float(x) for x in s.split(",")]
+
+    if len(extent) != 4 or extent[0] > extent[2] or extent[1] > extent[3]:
+        raise ValueError(f"bad bounding box: {s}")
+
+    return extent
+
+def coords_extent(coords):
+    """
+    Return the [west, south, east, north] extent of a list of
+    coordinates, or None if it's empty.
+    """
+
+    if coords == []:
+        return None
+
+    lons = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+def pad_extent(extent, meters):
+    """
+    Return the extent grown by the given number of meters on each side.
+    """
+
+    w, s, e, n = extent
+
+    dlat = meters / M_PER_DEG
+    dlon = meters / (M_PER_DEG * math.cos(math.radians((s + n) / 2)))
+
+    return [w - dlon, s - dlat, e + dlon, n + dlat]
+
+def extent_intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def extent_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and \
+        outer[2] >= inner[2] and outer[3] >= inner[3]
+
+def point_in_extent(lon, lat, extent):
+    return extent[0] <= lon <= extent[2] and extent[1] <= lat <= extent[3]
+
+def clip_segment(a, b, extent):
+    """
+    Clip the segment a-b to the extent (Liang-Barsky). Return the
+    (t0, t1) range of the segment inside it, or None if none of it is.
+    """
+
+    w, s, e, n = extent
+
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+
+    t0 = 0.0
+    t1 = 1.0
+
+    for p, q in ((-dx, a[0] - w), (dx, e - a[0]), (-dy, a[1] - s), (dy, n - a[1])):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+
+        t = q / p
+
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+
+    return t0, t1
+
+def interpolate(a, b, t):
+    if t == 0:
+        return a
+    if t == 1:
+        return b
+
+    return [x + (y - x) * t for x, y in zip(a, b)]
+
+def clip_coords(coords, extent):
+    """
+    Clip a polyline to the extent. Return a list of the coordinate
+    lists of the pieces inside it, with new points where the line
+    crosses the edge.
+    """
+
+    pieces = []
+    piece = []
+
+    for a, b in zip(coords, coords[1:]):
+        r = clip_segment(a, b, extent)
+
+        if r is None:
+            if piece != []:
+                pieces.append(piece)
+                piece = []
+            continue
+
+        t0, t1 = r
+
+        if t0 > 0 and piece != []:
+            pieces.append(piece)
+            piece = []
+
+        if piece == []:
+            piece.append(interpolate(a, b, t0))
+
+        piece.append(interpolate(a, b, t1))
+
+        if t1 < 1:
+            pieces.append(piece)
+            piece = []
+
+    if piece != []:
+        pieces.append(piece)
+
+    return [p for p in pieces if len(p) > 1]
+
+def clip_line(coords, extent, line_extent=None):
+    """
+    Return a list of the coordinate lists of the pieces of a polyline
+    inside the extent, like clip_coords().
+
+    Lines entirely inside or outside are decided from their extent
+    alone, given as line_extent if it's already known; a line entirely
+    inside comes back whole as the one piece, the same list. Only those
+    crossing the edge have their coordinates clipped.
+    """
+
+    if line_extent is None:
+        line_extent = coords_extent(coords)
+
+    if line_extent is None or not extent_intersects(extent, line_extent):
+        return []
+
+    if extent_contains(extent, line_extent):
+        return [coords]
+
+    return clip_coords(coords, extent)
+
+def feature_extent(f):
+    """
+    Return the extent of a GeoJSON feature, from its "bbox" member if
+    it has one, or None if it has no coordinates.
+    """
+
+    bbox = f.get("bbox")
+
+    if bbox is not None and len(bbox) == 4:
+        return bbox
+
+    geom = f.get("geometry")
+
+    if geom is None:
+        return None
+
+    coords = geom["coordinates"]
+
+    if geom["type"] == "Point":
+        return [coords[0], coords[1], coords[0], coords[1]]
+
+    return coords_extent(coords)
+
+def orientation(ax, ay, bx, by, cx, cy):
+    """
+    Return the sign of the turn a-b-c: 1 left, -1 right, 0 collinear.
+    """
+
+    v = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+    return (v > 0) - (v < 0)
+
+def segments_cross(a, b):
+    """
+    Return True if the projected segments a and b, each (ax, ay, bx, by),
+    properly cross. Touching at an endpoint or running collinear doesn't
+    count, so neighbors sharing a vertex never cross.
+    """
+
+    ax, ay, bx, by = a
+    cx, cy, dx, dy = b
+
+    o1 = orientation(ax, ay, bx, by, cx, cy)
+    o2 = orientation(ax, ay, bx, by, dx, dy)
+    o3 = orientation(cx, cy, dx, dy, ax, ay)
+    o4 = orientation(cx, cy, dx, dy, bx, by)
+
+    return o1 * o2 < 0 and o3 * o4 < 0
+
+def lonlat_segments_cross(a, b, c, d):
+    """
+    Return True if the segments a-b and c-d, in [lon, lat], properly
+    cross, like segments_cross().
+    """
+
+    kx = math.cos(math.radians((a[1] + b[1] + c[1] + d[1]) / 4))
+
+    return segments_cross((a[0] * kx, a[1], b[0] * kx, b[1]), \
+        (c[0] * kx, c[1], d[0] * kx, d[1]))
+
+def find_crossings(lines):
+    """
+    Return a list of (line index, segment index, line index, segment
+    index) for every pair of segments that properly cross, across all
+    the polylines.
+
+    This sweeps a line across the segments' extents along the wider
+    axis of the data, testing each segment only against the segments
+    the sweep line currently overlaps. Track segments are short next to
+    the route, so that set stays small and the sweep runs in about
+    O(n log n).
+    """
+
+    all_coords = [c for coords in lines for c in coords]
+
+    if all_coords == []:
+        return []
+
+    extent = coords_extent(all_coords)
+    kx = math.cos(math.radians((extent[1] + extent[3]) / 2))
+
+    # Sweep along whichever axis the data spreads out on more
+    swap = extent[3] - extent[1] > (extent[2] - extent[0]) * kx
+
+    segs = []
+
+    for li, coords in enumerate(lines):
+        if swap:
+            pts = [(c[1], c[0] * kx) for c in coords]
+        else:
+            pts = [(c[0] * kx, c[1]) for c in coords]
+
+        for si in range(len(pts) - 1):
+            (ax, ay), (bx, by) = pts[si], pts[si + 1]
+
+            segs.append((min(ax, bx), max(ax, bx), min(ay, by), max(ay, by), \
+                li, si, (ax, ay, bx, by)))
+
+    segs.sort(key=lambda s: s[0])
+
+    crossings = []
+
+    # Segments the sweep line is over, and a heap to retire them by
+    # their far end
+    active = {}
+    retire = []
+
+    for i, s in enumerate(segs):
+        xmin, xmax, ymin, ymax, li, si, pts = s
+
+        while retire != [] and retire[0][0] < xmin:
+            del active[heapq.heappop(retire)[1]]
+
+        for j, a in active.items():
+            if a[2] <= ymax and ymin <= a[3] and segments_cross(a[6], pts):
+                crossings.append((a[4], a[5], li, si))
+
+        active[i] = s
+        heapq.heappush(retire, (xmax, i))
+
+    return crossings
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+
+#
+# Catalog of every route's tracks and waypoints in an on-disk spatial
+# index, for "what passes near here" queries.
+#
+# The catalog is a SQLite database with R*Tree indexes over track
+# chunks (runs of consecutive track points) and waypoints. Building it
+# again only reindexes route files that have changed.
+#
+
+import os
+import sys
+import json
+import glob
+import sqlite3
+import hashlib
+
+from geoindex import lldist, SegmentGrid, dist_point_segment, pad_extent, \
+    coords_extent, extent_intersects, point_in_extent, lonlat_segments_cross
+from symbols import sym_normalize
+
+CATALOG_FILE = "build/catalog.sqlite"
+ROUTE_FILES = "json/*.json"
+
+# Track points per indexed chunk
+CHUNK_POINTS = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    id INTEGER PRIMARY KEY,
+    file TEXT UNIQUE,
+    name TEXT,
+    mtime REAL,
+    size INTEGER,
+    sha1 TEXT
+);
+
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    route_id INTEGER,
+    title TEXT,
+    coords TEXT
+);
+
+CREATE TABLE IF NOT EXISTS waypoints (
+    id INTEGER PRIMARY KEY,
+    route_id INTEGER,
+    title TEXT,
+    symbol TEXT,
+    lon REAL,
+    lat REAL
+);
+
+CREATE INDEX IF NOT EXISTS chunks_route ON chunks(route_id);
+CREATE INDEX IF NOT EXISTS waypoints_route ON waypoints(route_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_index
+    USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS waypoint_index
+    USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+"""
+
+def usage():
+    s = "usage: gjcatalog.py [options] build [json_file ...]\n" \
+        "       gjcatalog.py [options] near lat lon km\n" \
+        "       gjcatalog.py [options] corridor json_file km\n" \
+        f"       -c name      catalog file [default {CATALOG_FILE}]\n" \
+        "       --json       print query results as JSON\n" \
+        "       -v           verbose\n" \
+        "\n" \
+        f"build indexes the given route files [default {ROUTE_FILES}]\n" \
+        "near finds routes and waypoints within km of a point\n" \
+        "corridor finds them within km of the tracks in json_file"
+
+    print(s, file=sys.stderr)
+
+def usage_exit(status=1):
+    usage()
+    sys.exit(status)
+
+def log(s):
+    print(s, file=sys.stderr)
+
+class AppContext:
+    def __init__(self, argv):
+        self.argv = argv[:]
+
+        self.catalog_file_name = CATALOG_FILE
+        self.json_output = False
+        self.verbose = False
+        self.args = []
+
+        self.parse_cl()
+
+    def consume_option_with_arg(self):
+        self.argv.pop(0)
+
+        if self.argv == []:
+            usage_exit()
+
+    def read_c_option(self):
+        self.consume_option_with_arg()
+
+        self.catalog_file_name = self.argv[0]
+
+    def parse_cl(self):
+        self.command = self.argv.pop(0)
+
+        while self.argv != []:
+            if self.argv[0] == "-h" or self.argv[0] == "--help":
+                usage_exit(0)
+
+            elif self.argv[0] == "-c":
+                self.read_c_option()
+
+            elif self.argv[0] == "--json":
+                self.json_output = True
+
+            elif self.argv[0] == "-v":
+                self.verbose = True
+
+            else:
+                self.args.append(self.argv[0])
+
+            self.argv.pop(0)
+
+        if self.args == []:
+            usage_exit()
+
+        self.subcommand = self.args.pop(0)
+
+        try:
+            if self.subcommand == "build":
+                self.route_files = self.args
+
+            elif self.subcommand == "near" and len(self.args) == 3:
+                self.lat = float(self.args[0])
+                self.lon = float(self.args[1])
+                self.radius = float(self.args[2]) * 1000
+
+            elif self.subcommand == "corridor" and len(self.args) == 2:
+                self.corridor_file_name = self.args[0]
+                self.radius = float(self.args[1]) * 1000
+
+            else:
+                usage_exit()
+
+        except ValueError:
+            usage_exit(2)
+
+def open_catalog(file_name):
+    dir_name = os.path.dirname(file_name)
+
+    if dir_name != "":
+        os.makedirs(dir_name, exist_ok=True)
+
+    db = sqlite3.connect(file_name)
+    db.executescript(SCHEMA)
+
+    return db
+
+def file_sha1(file_name):
+    with open(file_name, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def chunk_coords(coords):
+    """
+    Yield runs of CHUNK_POINTS track points, each sharing its first
+    point with the end of the one before.
+    """
+
+    for start in range(0, max(len(coords) - 1, 1), CHUNK_POINTS - 1):
+        yield coords[start:start + CHUNK_POINTS]
+
+def delete_route(db, route_id):
+    db.execute("DELETE FROM chunk_index WHERE id IN " \
+        "(SELECT id FROM chunks WHERE route_id = ?)", (route_id,))
+    db.execute("DELETE FROM waypoint_index WHERE id IN " \
+        "(SELECT id FROM waypoints WHERE route_id = ?)", (route_id,))
+    db.execute("DELETE FROM chunks WHERE route_id = ?", (route_id,))
+    db.execute("DELETE FROM waypoints WHERE route_id = ?", (route_id,))
+    db.execute("DELETE FROM routes WHERE id = ?", (route_id,))
+
+def index_route(db, file_name, mtime, size, sha1):
+    """
+    Add a route file's tracks and waypoints to the catalog.
+    """
+
+    with open(file_name) as fp:
+        data = json.load(fp)
+
+    name = os.path.splitext(os.path.basename(file_name))[0]
+
+    cur = db.execute("INSERT INTO routes (file, name, mtime, size, sha1) " \
+        "VALUES (?, ?, ?, ?, ?)", (file_name, name, mtime, size, sha1))
+
+    route_id = cur.lastrowid
+
+    for f in data["features"]:
+        if f["type"] != "Feature" or f.get("geometry") is None:
+            continue
+
+        geom_type = f["geometry"]["type"]
+        coords = f["geometry"]["coordinates"]
+        title = f["properties"].get("title", "").strip()
+
+        if geom_type == "LineString":
+            for chunk in chunk_coords(coords):
+                chunk = [c[:2] for c in chunk]
+
+                if chunk == []:
+                    continue
+
+                cur = db.execute("INSERT INTO chunks (route_id, title, coords) " \
+                    "VALUES (?, ?, ?)", (route_id, title, json.dumps(chunk)))
+
+                w, s, e, n = coords_extent(chunk)
+
+                db.execute("INSERT INTO chunk_index VALUES (?, ?, ?, ?, ?)", \
+                    (cur.lastrowid, w, e, s, n))
+
+        elif geom_type == "Point":
+            sym = f["properties"].get("marker-symbol")
+
+            if sym is not None:
+                sym = sym_normalize(sym.split('$')[0], title)
+
+            lon, lat = coords[:2]
+
+            cur = db.execute("INSERT INTO waypoints " \
+                "(route_id, title, symbol, lon, lat) VALUES (?, ?, ?, ?, ?)", \
+                (route_id, title, sym, lon, lat))
+
+            db.execute("INSERT INTO waypoint_index VALUES (?, ?, ?, ?, ?)", \
+                (cur.lastrowid, lon, lon, lat, lat))
+
+def build_catalog(db, file_names, verbose):
+    """
+    Bring the catalog up to date with the route files, reindexing only
+    the ones that changed and dropping ones that no longer exist.
+    """
+
+    for file_name in file_names:
+        try:
+            st = os.stat(file_name)
+        except OSError as e:
+            log(f"{file_name}: {e.strerror}")
+            continue
+
+        row = db.execute("SELECT id, mtime, size, sha1 FROM routes " \
+            "WHERE file = ?", (file_name,)).fetchone()
+
+        if row is not None:
+            route_id, mtime, size, sha1 = row
+
+            if mtime == st.st_mtime and size == st.st_size:
+                continue
+
+            new_sha1 = file_sha1(file_name)
+
+            if new_sha1 == sha1:
+                db.execute("UPDATE routes SET mtime = ?, size = ? WHERE id = ?", \
+                    (st.st_mtime, st.st_size, route_id))
+                continue
+
+            delete_route(db, route_id)
+        else:
+            new_sha1 = file_sha1(file_name)
+
+        if verbose:
+            log(f"{file_name}: indexing")
+
+        index_route(db, file_name, st.st_mtime, st.st_size, new_sha1)
+
+    for route_id, file_name in db.execute("SELECT id, file FROM routes").fetchall():
+        if not os.path.exists(file_name):
+            if verbose:
+                log(f"{file_name}: removing")
+
+            delete_route(db, route_id)
+
+    db.commit()
+
+def candidates(db, table, extent):
+    """
+    Return the ids in the R*Tree index table whose boxes meet the extent.
+    """
+
+    w, s, e, n = extent
+
+    return [r[0] for r in db.execute(f"SELECT id FROM {table} " \
+        "WHERE max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?", \
+        (w, e, s, n))]
+
+def near_query(db, lat, lon, radius):
+    """
+    Return (tracks, waypoints) within radius meters of the point.
+
+    Tracks are (route, title, distance) with the closest distance per
+    track; waypoints are (route, title, symbol, distance).
+    """
+
+    extent = pad_extent([lon, lat, lon, lat], radius)
+
+    def track_dist(coords):
+        if len(coords) == 1:
+            return lldist(lat, lon, coords[0][1], coords[0][0])
+
+        return min(dist_point_segment(lon, lat, a, b)[0] \
+            for a, b in zip(coords, coords[1:]))
+
+    def waypoint_dist(wlon, wlat):
+        return lldist(lat, lon, wlat, wlon)
+
+    return run_query(db, [extent], track_dist, waypoint_dist, radius)
+
+def corridor_query(db, lines, radius):
+    """
+    Return (tracks, waypoints) within radius meters of the polylines,
+    like near_query().
+    """
+
+    grid = SegmentGrid(lines)
+
+    extents = [pad_extent(coords_extent(chunk), radius) \
+        for coords in lines for chunk in chunk_coords(coords)]
+
+    def point_dist(plon, plat):
+        nearest = grid.nearest(plon, plat, radius)
+
+        return None if nearest is None else nearest[0]
+
+    def track_dist(coords):
+        """
+        Distance between the chunk and the corridor, segment to
+        segment: 0 if they cross, else the closest any vertex of one
+        comes to a segment of the other.
+        """
+
+        dists = [d for d in (point_dist(*c[:2]) for c in coords) if d is not None]
+        best = min(dists, default=radius)
+
+        if best == 0:
+            return best
+
+        extent = coords_extent(coords)
+        pairs = list(zip(coords, coords[1:]))
+
+        for li, si in grid.segments_in(extent):
+            c, d = lines[li][si], lines[li][si + 1]
+
+            if not extent_intersects(extent, coords_extent([c, d])):
+                continue
+
+            for a, b in pairs:
+                if lonlat_segments_cross(a, b, c, d):
+                    return 0.0
+
+        # Only corridor vertices that could beat the chunk's own
+        near = pad_extent(extent, best)
+        seen = set()
+
+        for li, si in grid.segments_in(near):
+            for ci in (si, si + 1):
+                c = lines[li][ci]
+
+                if pairs == [] or (li, ci) in seen or \
+                        not point_in_extent(c[0], c[1], near):
+                    continue
+
+                seen.add((li, ci))
+                dists.append(min(dist_point_segment(c[0], c[1], a, b)[0] \
+                    for a, b in pairs))
+
+        return min(dists, default=None)
+
+    return run_query(db, extents, track_dist, point_dist, radius)
+
+def run_query(db, extents, track_dist, waypoint_dist, radius):
+    chunk_ids = set()
+    waypoint_ids = set()
+
+    for extent in extents:
+        chunk_ids.update(candidates(db, "chunk_index", extent))
+        waypoint_ids.update(candidates(db, "waypoint_index", extent))
+
+    tracks = {}
+
+    for chunk_id in chunk_ids:
+        route, title, coords = db.execute("SELECT routes.name, title, coords " \
+            "FROM chunks JOIN routes ON routes.id = route_id " \
+            "WHERE chunks.id = ?", (chunk_id,)).fetchone()
+
+        d = track_dist(json.loads(coords))
+
+        if d is not None and d <= radius:
+            key = (route, title)
+            tracks[key] = min(d, tracks.get(key, d))
+
+    waypoints = []
+
+    for waypoint_id in waypoint_ids:
+        route, title, sym, wlon, wlat = db.execute("SELECT routes.name, " \
+            "title, symbol, lon, lat FROM waypoints " \
+            "JOIN routes ON routes.id = route_id " \
+            "WHERE waypoints.id = ?", (waypoint_id,)).fetchone()
+
+        d = waypoint_dist(wlon, wlat)
+
+        if d is not None and d <= radius:
+            waypoints.append((route, title, sym, d))
+
+    tracks = sorted(((r, t, d) for (r, t), d in tracks.items()), \
+        key=lambda x: x[2])
+    waypoints.sort(key=lambda x: x[3])
+
+    return tracks, waypoints
+
+def read_corridor(file_name):
+    """
+    Return the LineString coordinates in a GeoJSON file.
+    """
+
+    if file_name == "-":
+        data = json.load(sys.stdin)
+    else:
+        with open(file_name) as fp:
+            data = json.load(fp)
+
+    return [f["geometry"]["coordinates"] for f in data["features"] \
+        if f.get("geometry") is not None \
+            and f["geometry"]["type"] == "LineString"]
+
+def print_results(tracks, waypoints, json_output):
+    if json_output:
+        print(json.dumps({
+            "tracks": [{"route": r, "title": t, "distance_m": d} \
+                for r, t, d in tracks],
+            "waypoints": [{"route": r, "title": t, "symbol": s, \
+                "distance_m": d} for r, t, s, d in waypoints],
+        }, indent=1))
+
+        return
+
+    print(f'{"route":<32} {"track":<32} {"km":>7}')
+
+    for r, t, d in tracks:
+        print(f'{r:<32.32} {t:<32.32} {d/1000:>7.2f}')
+
+    print()
+    print(f'{"route":<32} {"waypoint":<32} {"km":>7}  symbol')
+
+    for r, t, s, d in waypoints:
+        print(f'{r:<32.32} {t:<32.32} {d/1000:>7.2f}  {s or ""}')
+
+def main(argv):
+    ac = AppContext(argv)
+
+    db = open_catalog(ac.catalog_file_name)
+
+    if ac.subcommand == "build":
+        file_names = ac.route_files
+
+        if file_names == []:
+            file_names = sorted(glob.glob(ROUTE_FILES))
+
+        build_catalog(db, file_names, ac.verbose)
+
+    elif ac.subcommand == "near":
+        print_results(*near_query(db, ac.lat, ac.lon, ac.radius), \
+            ac.json_output)
+
+    elif ac.subcommand == "corridor":
+        lines = read_corridor(ac.corridor_file_name)
+        print_results(*corridor_query(db, lines, ac.radius), ac.json_output)
+
+    db.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,22 +1,47 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import sys
 import json
 import uuid
 import math
 
+from geoindex import lldist, parse_bbox, pad_extent, feature_extent, \
+    coords_extent, point_in_extent, clip_line, find_crossings, SegmentGrid, \
+    dist_point_segment
+from symbols import sym_normalize
+
 JOIN_MAX_DIST_M = 30
+SPIKE_MAX_DIST_M = 15
 DECIMAL_PLACES = 6
 
 def usage():
     s = "usage: gjretrack.py [options] json_file\n" \
+        "       --bbox w,s,e,n  keep only what's inside this lon/lat box\n" \
+        "       --bbox-from-waypoints regex\n" \
+        "                    box around the waypoints with matching titles\n" \
+        "       --bboxpad n  grow the box by n meters [default 0]\n" \
+        "       --clean n    drop duplicates, spikes, and points closer than n meters\n" \
+        "       --crossings  report track crossings introduced by smoothing\n" \
         f"       -d n         decimal places for lat, lon [default {DECIMAL_PLACES}]\n" \
+        "       --deviation  report how far smoothed tracks stray from the original\n" \
         "       -e           epsilon, smoothing max distance\n" \
+        "       --fixcrossings  restore points to undo crossings from smoothing\n" \
         "       --indent n   indent level, spaces\n" \
         "       -j           join tracks of same name\n" \
         f"       --joinmax n  maximum distance to join tracks [default {JOIN_MAX_DIST_M} meters]\n" \
+        "       --lod e[,e...]  smooth once to several epsilons, one track set each\n" \
+        "       --lodfiles   write each --lod level to its own -o file, name-lodE.json\n" \
         "       -m n         max points per track\n" \
+        "       --maxdev n   fail if a smoothed track strays over n meters\n" \
+        "                    (in true meters; -e reads lon, lat as lat, lon, so its\n" \
+        "                    epsilon doesn't line up: -e 5 can stray 10 m or more)\n" \
         "       -o name      output file name\n" \
+        f"       --spikemax n maximum spike length to clean [default {SPIKE_MAX_DIST_M} meters]\n" \
+        "       --stats fmt  print route statistics, fmt is table or json\n" \
+        "       --statsfile name  statistics output file [default stderr],\n" \
+        "                    - for stdout if -o names a file\n" \
         "       -v           verbose"
 
     print(s, file=sys.stderr)
@@ -41,6 +66,19 @@ class AppContext:
         self.epsilon = None
         self.decimal_places = DECIMAL_PLACES
         self.join_max_dist = JOIN_MAX_DIST_M
+        self.clean_dist = None
+        self.spike_max_dist = SPIKE_MAX_DIST_M
+        self.bbox = None
+        self.bbox_waypoints = None
+        self.bbox_pad = 0
+        self.check_crossings = False
+        self.fix_crossings = False
+        self.report_deviation = False
+        self.max_deviation = None
+        self.lod = None
+        self.lod_files = False
+        self.stats_format = None
+        self.stats_file_name = None
 
         self.parse_cl()
     
@@ -82,6 +120,64 @@ class AppContext:
         except:
             usage_exit(2)
     
+    def read_clean_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.clean_dist = float(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_spikemax_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.spike_max_dist = float(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_bbox_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox = parse_bbox(self.argv[0])
+        except ValueError:
+            usage_exit(2)
+
+    def read_bbox_from_waypoints_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox_waypoints = re.compile(self.argv[0], re.I)
+        except re.error:
+            usage_exit(2)
+
+    def read_bboxpad_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox_pad = float(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_maxdev_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.max_deviation = float(self.argv[0])
+        except:
+            usage_exit(2)
+
+        self.report_deviation = True
+
+    def read_lod_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.lod = sorted(float(e) for e in self.argv[0].split(","))
+        except:
+            usage_exit(2)
+
     def read_d_option(self):
         self.consume_option_with_arg()
 
@@ -95,6 +191,19 @@ class AppContext:
 
         self.out_file_name = self.argv[0]
 
+    def read_stats_option(self):
+        self.consume_option_with_arg()
+
+        if self.argv[0] not in ("table", "json"):
+            usage_exit(2)
+
+        self.stats_format = self.argv[0]
+
+    def read_statsfile_option(self):
+        self.consume_option_with_arg()
+
+        self.stats_file_name = self.argv[0]
+
     def parse_cl(self):
         self.command = self.argv.pop(0)
 
@@ -126,6 +235,46 @@ class AppContext:
             elif self.argv[0] == "--joinmax":
                 self.read_joinmax_option()
 
+            elif self.argv[0] == "--clean":
+                self.read_clean_option()
+
+            elif self.argv[0] == "--spikemax":
+                self.read_spikemax_option()
+
+            elif self.argv[0] == "--bbox":
+                self.read_bbox_option()
+
+            elif self.argv[0] == "--bbox-from-waypoints":
+                self.read_bbox_from_waypoints_option()
+
+            elif self.argv[0] == "--bboxpad":
+                self.read_bboxpad_option()
+
+            elif self.argv[0] == "--crossings":
+                self.check_crossings = True
+
+            elif self.argv[0] == "--fixcrossings":
+                self.check_crossings = True
+                self.fix_crossings = True
+
+            elif self.argv[0] == "--deviation":
+                self.report_deviation = True
+
+            elif self.argv[0] == "--maxdev":
+                self.read_maxdev_option()
+
+            elif self.argv[0] == "--lod":
+                self.read_lod_option()
+
+            elif self.argv[0] == "--lodfiles":
+                self.lod_files = True
+
+            elif self.argv[0] == "--stats":
+                self.read_stats_option()
+
+            elif self.argv[0] == "--statsfile":
+                self.read_statsfile_option()
+
             elif self.in_file_name is None:
                 self.in_file_name = self.argv[0]
 
@@ -143,23 +292,51 @@ class AppContext:
         if self.in_file_name is None:
             usage_exit()
 
-def lldist(lat1, lon1, lat2, lon2):
+        if self.bbox is not None and self.bbox_waypoints is not None:
+            usage_exit()
+
+        if self.lod is not None and self.epsilon is not None:
+            usage_exit()
+
+        if self.lod_files and (self.lod is None or \
+                self.out_file_name is None or self.out_file_name == "-"):
+            usage_exit()
+
+        # Statistics on stdout would land in front of the GeoJSON
+        if self.stats_file_name == "-" and \
+                (self.out_file_name is None or self.out_file_name == "-"):
+            usage_exit()
+
+def lldist_path(coords):
+    """
+    Return the list of distances in meters between consecutive
+    [lon, lat] coordinates.
+
+    This is lldist() over a whole coordinate list at once, with each
+    point's radians and cosine computed only once.
+    """
+
     R = 6.3781e6  # Earth radius in meters
 
-    a1 = lat1 * math.pi/180;
-    a2 = lat2 * math.pi/180;
-    d1 = (lat2-lat1) * math.pi/180;
-    d2 = (lon2-lon1) * math.pi/180;
+    rad = math.pi / 180
+
+    lats = [c[1] * rad for c in coords]
+    lons = [c[0] * rad for c in coords]
+    coslats = [math.cos(a) for a in lats]
 
-    a = math.sin(d1/2)**2 + \
-        math.cos(a1) * math.cos(a2) * \
-        math.sin(d2/2)**2;
+    dists = []
 
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a));
+    for i in range(len(coords) - 1):
+        d1 = lats[i + 1] - lats[i]
+        d2 = lons[i + 1] - lons[i]
 
-    d = R * c
+        a = math.sin(d1/2)**2 + \
+            coslats[i] * coslats[i + 1] * \
+            math.sin(d2/2)**2
 
-    return d  # meters
+        dists.append(R * 2 * math.atan2(math.sqrt(a), math.sqrt(1-a)))
+
+    return dists
 
 def dist_point_line(point, line0, line1):
     # https://en.wikipedia.org/wiki/Distance_from_a_point_to_a_line
@@ -230,30 +407,101 @@ def dist_point_great_circle(point, line0, line1):
 
     return abs(a * R)
 
-def douglas_peucker(track, epsilon, verbose):
-    # https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+def preclean(track, min_dist, spike_max, verbose):
+    """
+    Remove noise from a track in a single pass before simplifying.
+
+    Drops consecutive duplicate points, points closer than min_dist to
+    the last kept point, and out-and-back spikes no longer than
+    spike_max that return to within min_dist of where they left. The
+    track's first and last points are kept.
+    """
+
+    def dist(p1, p2):
+        return lldist(p1[1], p1[0], p2[1], p2[0])
+
+    coords = track["geometry"]["coordinates"]
+
+    if len(coords) < 3:
+        return track
+
+    dup_count = 0
+    close_count = 0
+    spike_count = 0
+
+    cleaned = [coords[0]]
+
+    for p in coords[1:]:
+        if p == cleaned[-1]:
+            dup_count += 1
+            continue
+
+        if dist(cleaned[-1], p) < min_dist:
+            close_count += 1
+            continue
+
+        if len(cleaned) >= 2 and dist(cleaned[-2], p) < min_dist and \
+                dist(cleaned[-2], cleaned[-1]) <= spike_max:
+            # Out to cleaned[-1] and right back again
+            cleaned.pop()
+            spike_count += 1
+            continue
+
+        cleaned.append(p)
+
+    # Dropped points were all near the last one kept, so stand the
+    # track's real endpoint in for it
+    if cleaned[-1] is not coords[-1]:
+        if len(cleaned) > 1:
+            cleaned[-1] = coords[-1]
+        else:
+            cleaned.append(coords[-1])
+
+    track["geometry"]["coordinates"] = cleaned
+
+    if verbose:
+        log(f'{track["properties"]["title"]}: cleaning: ' \
+            f"dropped {dup_count} duplicate, {close_count} close, " \
+            f"{spike_count} spike; " \
+            f"coord count after/before {len(cleaned)}/{len(coords)}")
+
+    return track
+
+def farthest_point(coords, first, last):
+    """
+    Return (index, distance) of the point between first and last
+    farthest from the great circle through them. The index is None if
+    none of them is off it.
+    """
+
+    max_dist = 0
+    max_dist_index = None
 
-    def dpr(points):
-        max_dist = 0
-        max_dist_index = None
+    for i in range(first + 1, last):
+        #pdist = dist_point_line(coords[i], coords[first], coords[last])
+        gcdist = dist_point_great_circle(coords[i], coords[first], coords[last])
 
-        for i in range(1, len(points) - 1):
-            #pdist = dist_point_line(points[i], points[0], points[-1])
-            gcdist = dist_point_great_circle(points[i], points[0], points[-1])
+        if gcdist > max_dist:
+            max_dist = gcdist
+            max_dist_index = i
 
-            if gcdist > max_dist:
-                max_dist = gcdist
-                max_dist_index = i
+    return max_dist_index, max_dist
+
+def douglas_peucker(track, epsilon, verbose):
+    # https://en.wikipedia.org/wiki/Ramer%E2%80%93Douglas%E2%80%93Peucker_algorithm
+
+    def dpr(first, last):
+        max_dist_index, max_dist = farthest_point(coords, first, last)
 
         if max_dist > epsilon:
-            left = dpr(points[:max_dist_index+1])
-            right = dpr(points[max_dist_index:])
+            left = dpr(first, max_dist_index)
+            right = dpr(max_dist_index, last)
 
             left.pop()
 
             result = left + right
         else:
-            result = [points[0], points[-1]]
+            result = [coords[first], coords[last]]
 
         return result
 
@@ -261,7 +509,7 @@ def douglas_peucker(track, epsilon, verbose):
 
     coord_count_before = len(coords)
 
-    simplified_coords = dpr(coords)
+    simplified_coords = dpr(0, len(coords) - 1)
     track["geometry"]["coordinates"] = simplified_coords
     
     coord_count_after = len(simplified_coords)
@@ -274,6 +522,244 @@ def douglas_peucker(track, epsilon, verbose):
 
     return track
 
+def dp_significance(coords):
+    """
+    Return for each coordinate the largest epsilon at which
+    douglas_peucker would drop it; it's kept for any smaller epsilon.
+
+    The split points don't depend on epsilon, so this runs the
+    subdivision all the way down once, with each point's significance
+    capped by its parent's. The endpoints are always kept.
+    """
+
+    n = len(coords)
+    sig = [0.0] * n
+
+    if n == 0:
+        return sig
+
+    sig[0] = sig[-1] = math.inf
+
+    stack = [(0, n - 1, math.inf)]
+
+    while stack != []:
+        first, last, parent_sig = stack.pop()
+
+        max_dist_index, max_dist = farthest_point(coords, first, last)
+
+        if max_dist_index is None:
+            continue
+
+        s = min(max_dist, parent_sig)
+        sig[max_dist_index] = s
+
+        stack.append((first, max_dist_index, s))
+        stack.append((max_dist_index, last, s))
+
+    return sig
+
+def lod_levels(processed, epsilons, rename, verbose):
+    """
+    Return a (epsilon, tracks) level for each epsilon, smallest first,
+    with tracks like processed: (track, coords before, coords cleaned).
+
+    Each track's significance is computed once and every level is a
+    filter on it, so each level is a subset of the one before and
+    matches douglas_peucker at that epsilon. If rename is set, the
+    level's tracks get it in their titles so levels can share a file.
+    """
+
+    sigs = [dp_significance(cc) for _, _, cc in processed]
+
+    levels = []
+
+    for epsilon in sorted(epsilons):
+        level = []
+
+        for (track, coords_before, coords_cleaned), sig in zip(processed, sigs):
+            new_track = {}
+            copy_track_props(new_track, track)
+
+            new_track["properties"]["lod"] = epsilon
+
+            if rename:
+                new_track["properties"]["title"] += f" lod{epsilon:g}"
+                new_track["id"] = str(uuid.uuid4())
+
+            coords = [c for c, s in zip(coords_cleaned, sig) if s > epsilon]
+            new_track["geometry"]["coordinates"] = coords
+
+            if verbose:
+                log(f'{track["properties"]["title"]}: lod {epsilon:g}: ' \
+                    "coord count after/before " \
+                    f"{len(coords)}/{len(coords_cleaned)}, " \
+                    f"{len(coords)/len(coords_cleaned)*100:.1f}%")
+
+            level.append((new_track, coords_before, coords_cleaned))
+
+        levels.append((epsilon, level))
+
+    return levels
+
+def kept_indices(coords, simplified):
+    """
+    Return the indices into coords of the simplified coordinates.
+
+    douglas_peucker keeps the original coordinate objects in their
+    original order, so they can be matched by identity.
+    """
+
+    kept = []
+    j = 0
+
+    for i, c in enumerate(coords):
+        if j < len(simplified) and c is simplified[j]:
+            kept.append(i)
+            j += 1
+
+    return kept
+
+def keep_points(level, kept):
+    """
+    Add back to each of the level's tracks the cleaned coordinates at
+    the given indices, so the level keeps every point another level
+    restored.
+    """
+
+    for (track, _, coords_cleaned), k in zip(level, kept):
+        have = kept_indices(coords_cleaned, get_feature_geom_coordinates(track))
+
+        track["geometry"]["coordinates"] = \
+            [coords_cleaned[i] for i in sorted(set(have) | k)]
+
+def introduced_crossings(simplified, kept):
+    """
+    Return the crossings between simplified segments whose stretches of
+    original track don't cross each other.
+    """
+
+    lines = [[coords[i] for i in k] for (_, coords), k in zip(simplified, kept)]
+
+    introduced = []
+
+    for li, si, lj, sj in find_crossings(lines):
+        a = simplified[li][1][kept[li][si]:kept[li][si + 1] + 1]
+        b = simplified[lj][1][kept[lj][sj]:kept[lj][sj + 1] + 1]
+
+        # Crossings between a and b, not within either
+        if not any(c[0] != c[2] for c in find_crossings([a, b])):
+            introduced.append((li, si, lj, sj))
+
+    return introduced
+
+def check_crossings(simplified, fix, verbose):
+    """
+    Report crossings between simplified tracks, or within one, that
+    their original coordinates don't have.
+
+    simplified is a list of (track, coords) pairs, where coords are the
+    track's coordinates before douglas_peucker. If fix is set, the
+    farthest original point is restored to each crossing segment until
+    no introduced crossings are left.
+
+    Return the number of introduced crossings remaining.
+    """
+
+    kept = [kept_indices(coords, get_feature_geom_coordinates(t)) \
+        for t, coords in simplified]
+
+    restored = [0] * len(simplified)
+
+    introduced = introduced_crossings(simplified, kept)
+
+    for li, si, lj, sj in introduced:
+        title = get_feature_property(simplified[li][0], "title")
+        other = get_feature_property(simplified[lj][0], "title")
+        lon, lat = simplified[li][1][kept[li][si]][:2]
+
+        log(f"{title}: crossings: crosses {other} near {lat}, {lon}")
+
+    while fix and introduced != []:
+        additions = [set() for _ in simplified]
+
+        for li, si, lj, sj in introduced:
+            for l, s in ((li, si), (lj, sj)):
+                i, _ = farthest_point(simplified[l][1], kept[l][s], kept[l][s + 1])
+
+                if i is not None:
+                    additions[l].add(i)
+
+        if not any(additions):
+            break
+
+        for l, added in enumerate(additions):
+            if added:
+                kept[l] = sorted(set(kept[l]) | added)
+                restored[l] += len(added)
+
+        introduced = introduced_crossings(simplified, kept)
+
+    for l, (t, coords) in enumerate(simplified):
+        title = get_feature_property(t, "title")
+
+        if restored[l] > 0:
+            t["geometry"]["coordinates"] = [coords[i] for i in kept[l]]
+
+            if verbose:
+                log(f"{title}: crossings: restored {restored[l]} points")
+
+    if fix:
+        log(f"crossings: {len(introduced)} left after restoring points")
+    else:
+        log(f"crossings: {len(introduced)} introduced by smoothing")
+
+    return len(introduced)
+
+def track_deviation(coords, simplified):
+    """
+    Return the (max, mean) distance in meters from each original
+    coordinate to the nearest segment of the simplified track.
+
+    The segment the previous point was closest to gives each lookup a
+    starting bound, so the grid search rarely leaves the point's own
+    cell.
+    """
+
+    if len(simplified) < 2 or coords == []:
+        return 0, 0
+
+    grid = SegmentGrid([simplified])
+
+    max_dev = 0
+    total = 0
+    si = 0
+
+    for c in coords:
+        lon, lat = c[0], c[1]
+
+        d = dist_point_segment(lon, lat, simplified[si], simplified[si + 1])[0]
+
+        # Walk forward while the next segment is closer
+        while si + 2 < len(simplified):
+            d_next = dist_point_segment(lon, lat, \
+                simplified[si + 1], simplified[si + 2])[0]
+
+            if d_next > d:
+                break
+
+            d = d_next
+            si += 1
+
+        nearest = grid.nearest(lon, lat, d)
+
+        if nearest is not None:
+            d = nearest[0]
+
+        max_dev = max(max_dev, d)
+        total += d
+
+    return max_dev, total / len(coords)
+
 def read_input_file(in_file_name):
     if in_file_name == "-":
         in_file = sys.stdin
@@ -495,6 +981,87 @@ def join_tracks(tracks, max_dist):
 
     return new_track
 
+def waypoints_extent(data, pattern):
+    """
+    Return the extent of the Points whose titles match the regex, or
+    None if none do.
+    """
+
+    matches = []
+
+    for f in data["features"]:
+        if f["type"] != "Feature" or get_feature_geom_type(f) != "Point":
+            continue
+
+        title = get_feature_property(f, "title")
+
+        if title is not None and pattern.search(title) is not None:
+            matches.append(get_feature_geom_coordinates(f))
+
+    return coords_extent(matches)
+
+def clip_waypoints(data, extent, verbose):
+    """
+    Remove the Points outside the extent from the data.
+    """
+
+    features = []
+    dropped = 0
+
+    for f in data["features"]:
+        if get_feature_geom_type(f) == "Point":
+            lon, lat = get_feature_geom_coordinates(f)[:2]
+
+            if not point_in_extent(lon, lat, extent):
+                dropped += 1
+                continue
+
+        features.append(f)
+
+    data["features"] = features
+
+    if verbose:
+        log(f"clipping: dropped {dropped} waypoints outside the box")
+
+def clip_track(track, extent, verbose):
+    """
+    Return a list of the parts of the track inside the extent, or the
+    track itself if it's all inside.
+    """
+
+    title = get_feature_property(track, "title")
+    coords = get_feature_geom_coordinates(track)
+
+    pieces = clip_line(coords, extent, feature_extent(track))
+
+    if pieces == []:
+        if verbose:
+            log(f"{title}: clipping: outside the box, skipping")
+
+        return []
+
+    if pieces[0] is coords:
+        return [track]
+
+    if verbose:
+        log(f"{title}: clipping: {len(pieces)} pieces inside the box")
+
+    new_tracks = []
+
+    for i, coords in enumerate(pieces):
+        piece = {}
+        copy_track_props(piece, track)
+
+        if len(pieces) > 1:
+            piece['properties']['title'] += f"-{i+1}"
+            piece['id'] = str(uuid.uuid4())
+
+        piece["geometry"]["coordinates"] = coords
+
+        new_tracks.append(piece)
+
+    return new_tracks
+
 def add_tracks(data, tracks):
     data["features"] += tracks
 
@@ -506,12 +1073,218 @@ def round_floats(o, p=6):
 
     return o
 
+def coords_stats(coords):
+    """
+    Return a dict of length and vertex spacing statistics for a list of
+    coordinates.
+    """
+
+    spacing = lldist_path(coords)
+    length = sum(spacing)
+
+    return {
+        "points": len(coords),
+        "length_m": length,
+        "spacing_avg_m": length / len(spacing) if spacing != [] else 0,
+        "spacing_max_m": max(spacing, default=0),
+    }
+
+def track_stats(title, coords_before, coords_after, split_tracks):
+    """
+    Return statistics for one track before and after smoothing, with
+    an entry for each of the segments it was split into.
+    """
+
+    stats = coords_stats(coords_after)
+    stats["title"] = title
+    stats["points_before"] = len(coords_before)
+    stats["length_before_m"] = sum(lldist_path(coords_before))
+
+    stats["segments"] = []
+
+    if len(split_tracks) > 1:
+        for t in split_tracks:
+            seg_stats = coords_stats(get_feature_geom_coordinates(t))
+            seg_stats["title"] = get_feature_property(t, "title")
+            stats["segments"].append(seg_stats)
+
+    return stats
+
+def waypoint_symbol_counts(data):
+    """
+    Return a dict of Point counts by normalized marker symbol.
+    """
+
+    counts = {}
+
+    for f in data["features"]:
+        if f["type"] != "Feature" or get_feature_geom_type(f) != "Point":
+            continue
+
+        sym = get_feature_property(f, "marker-symbol")
+        title = get_feature_property(f, "title")
+
+        if sym is not None:
+            sym = sym_normalize(sym.split('$')[0], title or "")
+
+        if sym is None:
+            sym = "unknown"
+
+        counts[sym] = counts.get(sym, 0) + 1
+
+    return dict(sorted(counts.items()))
+
+def route_stats(name, levels, data):
+    """
+    Return statistics for the whole route. levels is a list of
+    (epsilon, tracks stats) pairs, one per --lod level, or just the
+    one without --lod.
+    """
+
+    return {
+        "route": name,
+        "levels": [{
+            "epsilon": epsilon,
+            "length_m": sum(t["length_m"] for t in tracks_stats),
+            "points_before": sum(t["points_before"] for t in tracks_stats),
+            "points": sum(t["points"] for t in tracks_stats),
+            "tracks": tracks_stats,
+        } for epsilon, tracks_stats in levels],
+        "waypoints": waypoint_symbol_counts(data),
+    }
+
+def format_stats_table(stats):
+    """
+    Return the route statistics as a text table.
+    """
+
+    def row(title, points_before, s):
+        return f'{title:<32.32} {points_before:>8} {s["points"]:>8} ' \
+            f'{s["length_m"]/1000:>10.1f} {s["spacing_avg_m"]:>8.1f} ' \
+            f'{s["spacing_max_m"]:>8.1f}'
+
+    lines = []
+
+    for level in stats["levels"]:
+        if len(stats["levels"]) > 1:
+            lines.append(f'lod {level["epsilon"]:g}')
+
+        lines.append(f'{"track":<32} {"before":>8} {"after":>8} ' \
+            f'{"length km":>10} {"avg m":>8} {"max m":>8}')
+
+        for t in level["tracks"]:
+            lines.append(row(t["title"], t["points_before"], t))
+
+            for seg in t["segments"]:
+                lines.append(row("  " + seg["title"], "", seg))
+
+        lines.append(f'{stats["route"]:<32.32} {level["points_before"]:>8} ' \
+            f'{level["points"]:>8} {level["length_m"]/1000:>10.1f}')
+
+        lines.append("")
+
+    lines.append(f'{"waypoint symbol":<32} {"count":>8}')
+
+    for sym, count in stats["waypoints"].items():
+        lines.append(f'{sym:<32} {count:>8}')
+
+    lines.append(f'{"total":<32} {sum(stats["waypoints"].values()):>8}')
+
+    return "\n".join(lines)
+
+def write_stats(stats, stats_format, stats_file_name):
+    if stats_file_name is None:
+        fp = sys.stderr
+    elif stats_file_name == "-":
+        fp = sys.stdout
+    else:
+        fp = open(stats_file_name, "w")
+
+    if stats_format == "json":
+        print(json.dumps(stats, indent=1), file=fp)
+    else:
+        print(format_stats_table(stats), file=fp)
+
+    if fp not in (sys.stdout, sys.stderr):
+        fp.close()
+
+def finish_tracks(processed, max_points, report_deviation, max_deviation, \
+        do_stats, verbose):
+    """
+    Check deviation, split, and gather stats for smoothed tracks.
+
+    Return the split tracks, the per-track stats, and the number of
+    tracks over max_deviation.
+    """
+
+    new_tracks = []
+    tracks_stats = []
+    over_max_deviation = 0
+
+    for track, coords_before, _ in processed:
+        title = get_feature_property(track, "title")
+
+        if report_deviation:
+            max_dev, mean_dev = track_deviation(coords_before, \
+                get_feature_geom_coordinates(track))
+
+            log(f"{title}: deviation: max {max_dev:.1f} m, mean {mean_dev:.2f} m")
+
+            if max_deviation is not None and max_dev > max_deviation:
+                over_max_deviation += 1
+
+        split_tracks = split_track(track, max_points, verbose)
+
+        if do_stats:
+            stats = track_stats(title, coords_before, \
+                get_feature_geom_coordinates(track), split_tracks)
+
+            if report_deviation:
+                stats["deviation_max_m"] = max_dev
+                stats["deviation_mean_m"] = mean_dev
+
+            tracks_stats.append(stats)
+
+        new_tracks += split_tracks
+
+    return new_tracks, tracks_stats, over_max_deviation
+
+def lod_file_name(file_name, epsilon):
+    root, ext = os.path.splitext(file_name)
+
+    return f"{root}-lod{epsilon:g}{ext}"
+
+def write_output(out_file_name, data, decimal_places, indent_level):
+    if out_file_name is None or out_file_name == "-":
+        fp = sys.stdout
+    else:
+        fp = open(out_file_name, 'w')
+
+    print(json.dumps(round_floats(data, decimal_places), \
+        indent=indent_level), file=fp)
+
+    fp.close()
+
 def main(argv):
     ac = AppContext(argv)
 
     input_data = read_input_file(ac.in_file_name)
 
-    new_tracks = []
+    bbox = ac.bbox
+
+    if ac.bbox_waypoints is not None:
+        bbox = waypoints_extent(input_data, ac.bbox_waypoints)
+
+        if bbox is None:
+            log(f"clipping: fatal: no waypoints match " \
+                f"{ac.bbox_waypoints.pattern}")
+            sys.exit(4)
+
+    if bbox is not None:
+        bbox = pad_extent(bbox, ac.bbox_pad)
+        clip_waypoints(input_data, bbox, ac.verbose)
+
+    processed = []
 
     while True:
         track = extract_track(input_data, ac.join_tracks, \
@@ -520,24 +1293,86 @@ def main(argv):
         if track is None:
             break
 
-        if ac.epsilon is not None:
-            douglas_peucker(track, ac.epsilon, ac.verbose)
+        if bbox is not None:
+            tracks = clip_track(track, bbox, ac.verbose)
+        else:
+            tracks = [track]
 
-        split_tracks = split_track(track, ac.max_points, ac.verbose)
+        for track in tracks:
+            coords_before = get_feature_geom_coordinates(track)
 
-        new_tracks += split_tracks
+            if ac.clean_dist is not None:
+                preclean(track, ac.clean_dist, ac.spike_max_dist, ac.verbose)
 
-    add_tracks(input_data, new_tracks)
+            coords_cleaned = get_feature_geom_coordinates(track)
 
-    if ac.out_file_name is None or ac.out_file_name == "-":
-        fp = sys.stdout
+            if ac.epsilon is not None:
+                douglas_peucker(track, ac.epsilon, ac.verbose)
+
+            processed.append((track, coords_before, coords_cleaned))
+
+    if ac.lod is None:
+        levels = [(ac.epsilon, processed)]
     else:
-        fp = open(ac.out_file_name, 'w')
+        levels = lod_levels(processed, ac.lod, not ac.lod_files, ac.verbose)
 
-    print(json.dumps(round_floats(input_data, ac.decimal_places), \
-        indent=ac.indent_level), file=fp)
+    # Crossings can be between tracks, so wait until they're all
+    # smoothed. Coarsest level first, so points restored there can be
+    # kept in the finer levels, each still a subset of the one below.
+    if ac.check_crossings:
+        kept = None
 
-    fp.close()
+        for epsilon, level in reversed(levels):
+            if epsilon is None:
+                continue
+
+            if kept is not None:
+                keep_points(level, kept)
+
+            check_crossings([(t, cc) for t, _, cc in level], \
+                ac.fix_crossings, ac.verbose)
+
+            if ac.fix_crossings:
+                kept = [set(kept_indices(cc, get_feature_geom_coordinates(t))) \
+                    for t, _, cc in level]
+
+    levels_tracks = []
+    levels_stats = []
+    over_max_deviation = 0
+
+    for epsilon, level in levels:
+        new_tracks, tracks_stats, over = finish_tracks(level, ac.max_points, \
+            ac.report_deviation, ac.max_deviation, \
+            ac.stats_format is not None, ac.verbose)
+
+        levels_tracks.append(new_tracks)
+        over_max_deviation += over
+
+        levels_stats.append((epsilon, tracks_stats))
+
+    if over_max_deviation > 0:
+        log(f"deviation: fatal: {over_max_deviation} tracks stray over " \
+            f"{ac.max_deviation} m")
+        sys.exit(5)
+
+    if ac.stats_format is not None:
+        stats = route_stats(ac.in_file_name, levels_stats, input_data)
+        write_stats(stats, ac.stats_format, ac.stats_file_name)
+
+    if ac.lod_files:
+        for (epsilon, _), new_tracks in zip(levels, levels_tracks):
+            level_data = input_data.copy()
+            level_data["features"] = input_data["features"] + new_tracks
+
+            write_output(lod_file_name(ac.out_file_name, epsilon), \
+                level_data, ac.decimal_places, ac.indent_level)
+
+    else:
+        for new_tracks in levels_tracks:
+            add_tracks(input_data, new_tracks)
+
+        write_output(ac.out_file_name, input_data, ac.decimal_places, \
+            ac.indent_level)
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+#
+# Time and measure peak memory of each build stage on synthetic routes
+# of growing size, to spot anything that scales worse than it should.
+#
+# For each stage the report shows the growth exponent between
+# successive sizes: about 1 is linear, 2 is quadratic.
+#
+
+import io
+import sys
+import json
+import math
+import time
+import tracemalloc
+import contextlib
+
+import gjretrack
+import gjtogpx
+import gjsynth
+
+SIZES = [10000, 30000, 100000, 300000]
+EPSILON = 5
+CLEAN_DIST = 1
+MAX_POINTS = 1900
+
+# Growth exponents above this get flagged, if the stage took long
+# enough for the timing to mean anything
+SUPERLINEAR_EXPONENT = 1.4
+FLAG_MIN_SECONDS = 0.05
+
+def usage():
+    s = "usage: gjscale.py [options]\n" \
+        "       --csv name   also write results as CSV\n" \
+        f"       -f n         points per track fragment [default {gjsynth.FRAGMENT_POINTS}]\n" \
+        "       --nomem      skip the peak memory pass\n" \
+        f"       -n n[,n...]  track point counts [default {','.join(map(str, SIZES))}]\n" \
+        "       -w n         waypoint count [default track points / 50]"
+
+    print(s, file=sys.stderr)
+
+def usage_exit(status=1):
+    usage()
+    sys.exit(status)
+
+def log(s):
+    print(s, file=sys.stderr)
+
+class AppContext:
+    def __init__(self, argv):
+        self.argv = argv[:]
+
+        self.sizes = SIZES
+        self.fragment_points = gjsynth.FRAGMENT_POINTS
+        self.waypoint_count = None
+        self.measure_memory = True
+        self.csv_file_name = None
+
+        self.parse_cl()
+
+    def consume_option_with_arg(self):
+        self.argv.pop(0)
+
+        if self.argv == []:
+            usage_exit()
+
+    def read_n_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.sizes = [int(n) for n in self.argv[0].split(",")]
+        except:
+            usage_exit(2)
+
+    def read_f_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.fragment_points = int(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_w_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.waypoint_count = int(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_csv_option(self):
+        self.consume_option_with_arg()
+
+        self.csv_file_name = self.argv[0]
+
+    def parse_cl(self):
+        self.command = self.argv.pop(0)
+
+        while self.argv != []:
+            if self.argv[0] == "-h" or self.argv[0] == "--help":
+                usage_exit(0)
+
+            elif self.argv[0] == "-n":
+                self.read_n_option()
+
+            elif self.argv[0] == "-f":
+                self.read_f_option()
+
+            elif self.argv[0] == "-w":
+                self.read_w_option()
+
+            elif self.argv[0] == "--nomem":
+                self.measure_memory = False
+
+            elif self.argv[0] == "--csv":
+                self.read_csv_option()
+
+            else:
+                usage_exit()
+
+            self.argv.pop(0)
+
+def stage_join(data):
+    tracks = []
+
+    while True:
+        track = gjretrack.extract_track(data, True, \
+            gjretrack.JOIN_MAX_DIST_M, False)
+
+        if track is None:
+            break
+
+        tracks.append(track)
+
+    return data, tracks
+
+def stage_clean(state):
+    data, tracks = state
+
+    for t in tracks:
+        gjretrack.preclean(t, CLEAN_DIST, gjretrack.SPIKE_MAX_DIST_M, False)
+
+    return state
+
+def stage_simplify(state):
+    data, tracks = state
+
+    for t in tracks:
+        gjretrack.douglas_peucker(t, EPSILON, False)
+
+    return state
+
+def stage_split(state):
+    data, tracks = state
+
+    for t in tracks:
+        gjretrack.add_tracks(data, gjretrack.split_track(t, MAX_POINTS))
+
+    return data
+
+def stage_dump(data):
+    return json.dumps(gjretrack.round_floats(data, gjretrack.DECIMAL_PLACES))
+
+def stage_read_gpx(text):
+    # Keep the unknown symbol warnings out of the report
+    with contextlib.redirect_stderr(io.StringIO()):
+        return gjtogpx.get_waypoints_tracks(json.loads(text))
+
+def stage_mile_markers(state):
+    waypoints, tracks = state
+
+    gjtogpx.locate_waypoints(waypoints, tracks)
+
+    return state
+
+def stage_write_gpx(state):
+    waypoints, tracks = state
+
+    return gjtogpx.toxml("scale", waypoints, tracks)
+
+# Each stage takes the previous stage's result
+STAGES = [
+    ("parse", json.loads),
+    ("join", stage_join),
+    ("clean", stage_clean),
+    ("simplify", stage_simplify),
+    ("split", stage_split),
+    ("dump", stage_dump),
+    ("gpx read", stage_read_gpx),
+    ("milemarkers", stage_mile_markers),
+    ("gpx write", stage_write_gpx),
+]
+
+def run_stages(text, measure_memory):
+    """
+    Run the pipeline on the GeoJSON text, returning a dict of stage
+    name to seconds, or to peak bytes if measure_memory is set. A stage
+    that fails stops the run and is recorded as None.
+    """
+
+    results = {}
+    state = text
+
+    if measure_memory:
+        tracemalloc.start()
+
+    try:
+        for name, stage in STAGES:
+            if measure_memory:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+
+            start = time.perf_counter()
+
+            try:
+                state = stage(state)
+            except (RecursionError, MemoryError, SystemExit) as e:
+                log(f"{name}: failed: {type(e).__name__}")
+                results[name] = None
+                break
+
+            if measure_memory:
+                results[name] = tracemalloc.get_traced_memory()[1] - base
+            else:
+                results[name] = time.perf_counter() - start
+
+    finally:
+        if measure_memory:
+            tracemalloc.stop()
+
+    return results
+
+def growth_exponent(n0, v0, n1, v1):
+    if v0 is None or v1 is None or v0 <= 0 or v1 <= 0:
+        return None
+
+    return math.log(v1 / v0) / math.log(n1 / n0)
+
+def format_report(sizes, times, mems):
+    """
+    Return the results as a table of time and peak memory per stage
+    and size, with the growth exponent from the previous size.
+    """
+
+    def fmt(v, scale, unit):
+        return "failed" if v is None else f"{v * scale:.3f}{unit}"
+
+    lines = [f'{"stage":<12} {"points":>9} {"time":>10} {"exp":>5} ' \
+        f'{"peak mem":>10} {"exp":>5}']
+
+    for name, _ in STAGES:
+        for i, n in enumerate(sizes):
+            t = times[i].get(name)
+            m = mems[i].get(name) if mems is not None else None
+
+            t_exp = m_exp = None
+
+            if i > 0:
+                t_exp = growth_exponent(sizes[i-1], times[i-1].get(name), n, t)
+
+                if mems is not None:
+                    m_exp = growth_exponent(sizes[i-1], mems[i-1].get(name), n, m)
+
+            flag = " <-- superlinear" \
+                if t_exp is not None and t_exp > SUPERLINEAR_EXPONENT \
+                    and t >= FLAG_MIN_SECONDS else ""
+
+            t_exp = "" if t_exp is None else f"{t_exp:.2f}"
+            m_exp = "" if m_exp is None else f"{m_exp:.2f}"
+            mem = "" if mems is None else fmt(m, 1 / 2**20, "M")
+
+            lines.append(f'{name if i == 0 else "":<12} {n:>9} ' \
+                f'{fmt(t, 1, "s"):>10} {t_exp:>5} {mem:>10} {m_exp:>5}{flag}')
+
+    return "\n".join(lines)
+
+def write_csv(file_name, sizes, times, mems):
+    with open(file_name, "w") as fp:
+        print("stage,points,seconds,peak_bytes", file=fp)
+
+        for name, _ in STAGES:
+            for i, n in enumerate(sizes):
+                t = times[i].get(name)
+                m = mems[i].get(name) if mems is not None else None
+
+                print(f'{name},{n},{"" if t is None else t},' \
+                    f'{"" if m is None else m}', file=fp)
+
+def main(argv):
+    ac = AppContext(argv)
+
+    times = []
+    mems = [] if ac.measure_memory else None
+
+    for n in ac.sizes:
+        waypoint_count = ac.waypoint_count
+
+        if waypoint_count is None:
+            waypoint_count = n // 50
+
+        log(f"{n} points, {waypoint_count} waypoints: generating")
+
+        text = json.dumps(gjsynth.make_route(n, ac.fragment_points, \
+            waypoint_count, gjsynth.SEED))
+
+        log(f"{n} points: timing")
+        times.append(run_stages(text, False))
+
+        if ac.measure_memory:
+            log(f"{n} points: measuring memory")
+            mems.append(run_stages(text, True))
+
+    print(format_report(ac.sizes, times, mems))
+
+    if ac.csv_file_name is not None:
+        write_csv(ac.csv_file_name, ac.sizes, times, mems)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+#
+# Generate a synthetic GeoJSON route for testing at scale.
+#
+# The output looks like the bundled exports: folder features with null
+# geometry, a random-walk track with switchbacks broken into shuffled,
+# partly reversed LineString fragments with duplicated endpoints, and
+# Points with a mix of marker symbols. The same seed always gives the
+# same file.
+#
+
+import sys
+import json
+import math
+import uuid
+import random
+
+POINT_COUNT = 30000
+FRAGMENT_POINTS = 2000
+WAYPOINT_COUNT = 600
+SEED = 1
+
+START_LON = -120.0
+START_LAT = 44.0
+
+# Random walk step, meters
+STEP_MIN_M = 5
+STEP_MAX_M = 60
+
+# Chance per point of starting a switchback run
+SWITCHBACK_CHANCE = 0.002
+
+# Chance per point of an exported duplicate
+DUPLICATE_CHANCE = 0.05
+
+# Fraction of fragments written backwards
+REVERSE_FRACTION = 0.3
+
+# Furthest a waypoint sits from the track, meters
+WAYPOINT_MAX_OFFSET_M = 3000
+
+M_PER_DEG = 6.3781e6 * math.pi / 180
+
+# (marker-symbol, title) samples, including ones sym_normalize rewrites
+WAYPOINT_KINDS = [
+    ("camping", "Campground"),
+    ("camping", "Dispersed campsite"),
+    ("fuel", "Gas"),
+    ("foodservice", "Cafe"),
+    ("foodservice", "Brewpub"),
+    ("restroom", "Vault toilet"),
+    ("drinking-water", "Spring"),
+    ("swimming", "Hot spring"),
+    ("photo", "Viewpoint"),
+    ("danger", "Washout"),
+    ("danger", "Pioneer cemetery"),
+    ("gate-side", "Gate"),
+    ("flag-1", "Waypoint"),
+    ("lodging", "Motel"),
+    ("placemark2", "Rest area"),
+    ("placemark2", "Post office"),
+    ("placemark2", "Old mines"),
+    ("placemark2", "Junction"),
+    ("placemark2", "Somewhere"),
+    ("fuel$1", "Gas"),
+]
+
+def usage():
+    s = "usage: gjsynth.py [options]\n" \
+        f"       -f n         points per track fragment [default {FRAGMENT_POINTS}]\n" \
+        f"       -n n         track point count [default {POINT_COUNT}]\n" \
+        "       -o name      output file name\n" \
+        f"       -s n         random seed [default {SEED}]\n" \
+        f"       -w n         waypoint count [default {WAYPOINT_COUNT}]"
+
+    print(s, file=sys.stderr)
+
+def usage_exit(status=1):
+    usage()
+    sys.exit(status)
+
+class AppContext:
+    def __init__(self, argv):
+        self.argv = argv[:]
+
+        self.point_count = POINT_COUNT
+        self.fragment_points = FRAGMENT_POINTS
+        self.waypoint_count = WAYPOINT_COUNT
+        self.seed = SEED
+        self.out_file_name = None
+
+        self.parse_cl()
+
+    def consume_option_with_arg(self):
+        self.argv.pop(0)
+
+        if self.argv == []:
+            usage_exit()
+
+    def read_int_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            return int(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_o_option(self):
+        self.consume_option_with_arg()
+
+        self.out_file_name = self.argv[0]
+
+    def parse_cl(self):
+        self.command = self.argv.pop(0)
+
+        while self.argv != []:
+            if self.argv[0] == "-h" or self.argv[0] == "--help":
+                usage_exit(0)
+
+            elif self.argv[0] == "-n":
+                self.point_count = self.read_int_option()
+
+            elif self.argv[0] == "-f":
+                self.fragment_points = self.read_int_option()
+
+            elif self.argv[0] == "-w":
+                self.waypoint_count = self.read_int_option()
+
+            elif self.argv[0] == "-s":
+                self.seed = self.read_int_option()
+
+            elif self.argv[0] == "-o":
+                self.read_o_option()
+
+            else:
+                usage_exit()
+
+            self.argv.pop(0)
+
+def make_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def offset_coord(lon, lat, heading, dist):
+    """
+    Return [lon, lat] moved dist meters from the point along heading
+    (radians, counterclockwise from east).
+    """
+
+    dlat = dist * math.sin(heading) / M_PER_DEG
+    dlon = dist * math.cos(heading) / (M_PER_DEG * math.cos(math.radians(lat)))
+
+    return [round(lon + dlon, 6), round(lat + dlat, 6)]
+
+def random_walk(rng, point_count):
+    """
+    Return a list of [lon, lat] coordinates wandering across the map,
+    with occasional runs of switchbacks and exported duplicates.
+    """
+
+    coords = [[START_LON, START_LAT]]
+
+    heading = rng.uniform(0, 2 * math.pi)
+    switchback_left = 0
+    switchback_leg = 0
+
+    while len(coords) < point_count:
+        lon, lat = coords[-1]
+
+        if rng.random() < DUPLICATE_CHANCE:
+            coords.append([lon, lat])
+            continue
+
+        if switchback_left == 0 and rng.random() < SWITCHBACK_CHANCE:
+            switchback_left = rng.randint(4, 12)
+            switchback_leg = rng.randint(5, 20)
+
+        if switchback_left > 0:
+            switchback_leg -= 1
+
+            if switchback_leg == 0:
+                # Hairpin, then back the other way
+                heading += math.pi * rng.uniform(0.85, 0.95) * \
+                    (1 if switchback_left % 2 else -1)
+                switchback_left -= 1
+                switchback_leg = rng.randint(5, 20)
+        else:
+            heading += rng.gauss(0, 0.2)
+
+        dist = rng.uniform(STEP_MIN_M, STEP_MAX_M)
+
+        coords.append(offset_coord(lon, lat, heading, dist))
+
+    return coords
+
+def fragment(rng, coords, fragment_points):
+    """
+    Break the coordinates into fragments that share their endpoints,
+    some reversed, in shuffled order.
+    """
+
+    fragments = []
+    start = 0
+
+    while start < len(coords) - 1:
+        length = max(2, int(rng.uniform(0.5, 1.5) * fragment_points))
+        end = min(len(coords) - 1, start + length)
+
+        frag = coords[start:end + 1]
+
+        if rng.random() < REVERSE_FRACTION:
+            frag.reverse()
+
+        fragments.append(frag)
+        start = end
+
+    first = fragments.pop(0)
+    rng.shuffle(fragments)
+
+    # join_tracks grows from the first fragment, so leave a real one there
+    return [first] + fragments
+
+def feature(rng, props, geometry):
+    return {
+        "geometry": geometry,
+        "id": make_id(rng),
+        "type": "Feature",
+        "properties": props,
+    }
+
+def make_route(point_count, fragment_points, waypoint_count, seed):
+    """
+    Return a synthetic route as a GeoJSON FeatureCollection dict.
+    """
+
+    rng = random.Random(seed)
+
+    title = f"Synthetic-{seed}"
+
+    features = [
+        feature(rng, {"title": "Waypoints", "class": "Folder"}, None),
+        feature(rng, {"title": "Tracks", "class": "Folder"}, None),
+    ]
+
+    coords = random_walk(rng, point_count)
+
+    for frag in fragment(rng, coords, fragment_points):
+        features.append(feature(rng, {
+            "title": title,
+            "class": "Shape",
+            "stroke": "#FF0000",
+        }, {"type": "LineString", "coordinates": frag}))
+
+    for i in range(waypoint_count):
+        sym, name = rng.choice(WAYPOINT_KINDS)
+        lon, lat = rng.choice(coords)
+
+        props = {
+            "title": f"{name} {i+1}",
+            "class": "Marker",
+            "marker-symbol": sym,
+            "marker-color": "#FF0000" if rng.random() < 0.05 else "#0000FF",
+        }
+
+        if rng.random() < 0.5:
+            props["description"] = f"{name} near the route"
+
+        point = offset_coord(lon, lat, rng.uniform(0, 2 * math.pi),
+            rng.uniform(0, WAYPOINT_MAX_OFFSET_M) * rng.random()**4)
+
+        features.append(feature(rng, props, \
+            {"type": "Point", "coordinates": point}))
+
+    return {"type": "FeatureCollection", "features": features}
+
+def main(argv):
+    ac = AppContext(argv)
+
+    data = make_route(ac.point_count, ac.fragment_points, \
+        ac.waypoint_count, ac.seed)
+
+    if ac.out_file_name is None or ac.out_file_name == "-":
+        fp = sys.stdout
+    else:
+        fp = open(ac.out_file_name, 'w')
+
+    print(json.dumps(data), file=fp)
+
+    fp.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -7,21 +7,54 @@
 #
 # https://freegeographytools.com/2008/garmin-gps-unit-waypoint-icons-table
 
+import os
 import sys
 import json
 import re
+import gzip
+from decimal import Decimal
 from xml.sax.saxutils import escape
 
+from geoindex import lldist, SegmentGrid, parse_bbox, pad_extent, coords_extent, \
+    point_in_extent, clip_line
+from symbols import sym_normalize
+
+DECIMAL_PLACES = 6
+
+M_PER_MILE = 1609.344
+
+# Waypoints closer than this to the route aren't called out as off it
+OFF_ROUTE_MIN_MI = 0.1
+
+# Per-device limits: points per track, tracks per file, waypoints per
+# file. None is no limit. These are conservative; check the manual for
+# your unit.
+DEVICE_PROFILES = {
+    "garmin": {"max_points": 1900, "max_tracks": 200, "max_waypoints": 500},
+    "garmin-small": {"max_points": 500, "max_tracks": 20, "max_waypoints": 200},
+    "osmand": {"max_points": None, "max_tracks": None, "max_waypoints": None},
+}
+
 class Waypoint:
-    def __init__(self, name, lat, lon, garmin_sym, osmand_sym, color, desc=None):
+    def __init__(self, name, lat, lon, sym, garmin_sym, osmand_sym, color, desc=None,
+            marker_color=None):
         self.name = name
         self.lat = lat
         self.lon = lon
+        self.sym = sym
         self.garmin_sym = garmin_sym
         self.osmand_sym = osmand_sym
         self.color = color
         self.desc = desc
 
+        # The route's own color; color is the OsmAnd one
+        self.marker_color = marker_color if marker_color is not None else color
+
+        # Filled in by locate_waypoints()
+        self.track_index = None
+        self.route_dist = None
+        self.route_offset = None
+
 class Track:
     def __init__(self, name, coords):
         self.name = name
@@ -32,33 +65,270 @@ def usage():
     Print a usage message.
     """
 
-    print("usage: gjwaypoints.py file.json name", file=sys.stderr)
+    s = "usage: gjtogpx.py [options] file.json name\n" \
+        "       --bbox w,s,e,n  keep only what's inside this lon/lat box\n" \
+        "       --bbox-from-waypoints regex\n" \
+        "                    box around the waypoints with matching names\n" \
+        "       --bboxpad n  grow the box by n meters [default 0]\n" \
+        "       --compact    self-closing track points, rounded to -d places\n" \
+        "       --device name  pack into as few files as fit the device, any of:\n" \
+        f"                    {', '.join(DEVICE_PROFILES)}\n" \
+        f"       -d n         decimal places for lat, lon [default {DECIMAL_PLACES}]\n" \
+        "       --maxtracks n  tracks per file, overriding --device\n" \
+        "       --maxwpts n  waypoints per file, overriding --device\n" \
+        "       --milemarkers  add route distance to waypoint comments\n" \
+        "       -o name      output file name, or base name if more than one target;\n" \
+        "                    packed files are numbered name-1, name-2, ...\n" \
+        "       -t target[,target...]\n" \
+        "                    output formats, any of: " \
+        f"{', '.join(EMITTERS)} [default gpx]\n" \
+        "       -z           gzip the output"
+
+    print(s, file=sys.stderr)
+
+def usage_exit(status=1):
+    usage()
+    sys.exit(status)
+
+class AppContext:
+    def __init__(self, argv):
+        self.argv = argv[:]
+
+        self.in_file_name = None
+        self.name = None
+        self.out_file_name = None
+        self.compact = False
+        self.gzip = False
+        self.mile_markers = False
+        self.targets = ["gpx"]
+        self.bbox = None
+        self.bbox_waypoints = None
+        self.bbox_pad = 0
+        self.max_points = None
+        self.max_tracks = None
+        self.max_waypoints = None
+        self.decimal_places = DECIMAL_PLACES
+
+        self.parse_cl()
+
+    def consume_option_with_arg(self):
+        self.argv.pop(0)
+
+        if self.argv == []:
+            usage_exit()
+
+    def read_d_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.decimal_places = int(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_o_option(self):
+        self.consume_option_with_arg()
+
+        self.out_file_name = self.argv[0]
+
+    def read_bbox_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox = parse_bbox(self.argv[0])
+        except ValueError:
+            usage_exit(2)
+
+    def read_bbox_from_waypoints_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox_waypoints = re.compile(self.argv[0], re.I)
+        except re.error:
+            usage_exit(2)
+
+    def read_bboxpad_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.bbox_pad = float(self.argv[0])
+        except:
+            usage_exit(2)
+
+    def read_device_option(self):
+        self.consume_option_with_arg()
+
+        if self.argv[0] not in DEVICE_PROFILES:
+            usage_exit(2)
+
+        profile = DEVICE_PROFILES[self.argv[0]]
+
+        self.max_points = profile["max_points"]
+
+        # Explicit --maxtracks and --maxwpts win wherever they are
+        if self.max_tracks is None:
+            self.max_tracks = profile["max_tracks"]
+
+        if self.max_waypoints is None:
+            self.max_waypoints = profile["max_waypoints"]
+
+    def read_maxtracks_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.max_tracks = int(self.argv[0])
+        except:
+            usage_exit(2)
+
+        if self.max_tracks < 1:
+            usage_exit(2)
+
+    def read_maxwpts_option(self):
+        self.consume_option_with_arg()
+
+        try:
+            self.max_waypoints = int(self.argv[0])
+        except:
+            usage_exit(2)
+
+        if self.max_waypoints < 1:
+            usage_exit(2)
+
+    def read_t_option(self):
+        self.consume_option_with_arg()
+
+        self.targets = self.argv[0].split(",")
+
+        for t in self.targets:
+            if t not in EMITTERS:
+                usage_exit(2)
+
+    def parse_cl(self):
+        self.command = self.argv.pop(0)
+
+        while self.argv != []:
+            if self.argv[0] == "-h" or self.argv[0] == "--help":
+                usage_exit(0)
+
+            elif self.argv[0] == "--compact":
+                self.compact = True
+
+            elif self.argv[0] == "-z":
+                self.gzip = True
+
+            elif self.argv[0] == "--milemarkers":
+                self.mile_markers = True
+
+            elif self.argv[0] == "-d":
+                self.read_d_option()
+
+            elif self.argv[0] == "-o":
+                self.read_o_option()
+
+            elif self.argv[0] == "-t":
+                self.read_t_option()
+
+            elif self.argv[0] == "--bbox":
+                self.read_bbox_option()
+
+            elif self.argv[0] == "--bbox-from-waypoints":
+                self.read_bbox_from_waypoints_option()
+
+            elif self.argv[0] == "--bboxpad":
+                self.read_bboxpad_option()
+
+            elif self.argv[0] == "--device":
+                self.read_device_option()
+
+            elif self.argv[0] == "--maxtracks":
+                self.read_maxtracks_option()
+
+            elif self.argv[0] == "--maxwpts":
+                self.read_maxwpts_option()
+
+            elif self.in_file_name is None:
+                self.in_file_name = self.argv[0]
+
+            elif self.name is None:
+                self.name = self.argv[0]
+
+            else:
+                usage_exit()
+
+            self.argv.pop(0)
+
+        if self.in_file_name is None or self.name is None:
+            usage_exit()
+
+        if self.bbox is not None and self.bbox_waypoints is not None:
+            usage_exit()
+
+        # Multiple targets need a base name to hang their suffixes on
+        if len(self.targets) > 1 and \
+                (self.out_file_name is None or self.out_file_name == "-"):
+            usage_exit()
+
+def round_coord(x, places):
+    """
+    Return a coordinate rounded to the given number of decimal places,
+    as fixed-point text with any trailing zeros dropped.
+
+    GPX lat and lon are xsd:decimal, which has no exponent form, so
+    this never writes one the way repr() does near zero (4e-05).
+    """
+
+    s = f'{x:.{places}f}'
 
-def toxml(name, waypoints, tracks):
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+
+    return '0' if s == '-0' else s
+
+def decimal_text(x):
+    """
+    Return a coordinate as fixed-point text with all of its digits.
+    """
+
+    return format(Decimal(repr(x)), 'f')
+
+def toxml(name, waypoints, tracks, compact=False, places=DECIMAL_PLACES,
+        garmin=True, osmand=True):
     """
     Return XML string of all data.
+
+    In compact mode track points are self-closing and rounded to
+    `places` decimal places, the same as waypoints.
+
+    The garmin and osmand flags include the Garmin <sym> and the
+    OsmAnd icon extensions, respectively.
     """
 
     r = '<?xml version="1.0"?><gpx version="1.0" creator="gjwaypoints" ' \
-        'xmlns="http://www.topografix.com/GPX/1/0" ' \
-        'xmlns:osmand="https://osmand.net/docs/technical/osmand-file-formats/osmand-gpx" ' \
-        'xmlns:gpxtpx="https://www8.garmin.com/xmlschemas/TrackPointExtensionv1.xsd" ' \
+        'xmlns="http://www.topografix.com/GPX/1/0" '
+
+    if osmand:
+        r += 'xmlns:osmand="https://osmand.net/docs/technical/osmand-file-formats/osmand-gpx" '
+
+    r += 'xmlns:gpxtpx="https://www8.garmin.com/xmlschemas/TrackPointExtensionv1.xsd" ' \
         'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
         'xsi:schemaLocation="http://www.topografix.com/GPX/1/0 ' \
         'http://www.topografix.com/GPX/1/0/gpx.xsd">' \
         f'<name>{name}</name>'
 
     for w in waypoints:
-        r += f'<wpt lat="{w.lat}" lon="{w.lon}">'
+        r += f'<wpt lat="{round_coord(w.lat, places)}" ' \
+            f'lon="{round_coord(w.lon, places)}">'
         r += f'<name>{escape(w.name)}</name>'
-        r += f'<sym>{w.garmin_sym}</sym>'
-        if w.desc is not None:
-            r += f'<cmt>{escape(w.desc)}</cmt>'
-        r += '<extensions>'
-        r += f'<osmand:color>{w.color}</osmand:color>'
-        r += f'<osmand:icon>{w.osmand_sym}</osmand:icon>'
-        r += f'<osmand:background>circle</osmand:background>'
-        r += '</extensions>'
+        if garmin:
+            r += f'<sym>{w.garmin_sym}</sym>'
+        cmt = waypoint_comment(w)
+        if cmt is not None:
+            r += f'<cmt>{escape(cmt)}</cmt>'
+        if osmand:
+            r += '<extensions>'
+            r += f'<osmand:color>{w.color}</osmand:color>'
+            r += f'<osmand:icon>{w.osmand_sym}</osmand:icon>'
+            r += f'<osmand:background>circle</osmand:background>'
+            r += '</extensions>'
         r += '</wpt>'
 
     for t in tracks:
@@ -66,11 +336,18 @@ def toxml(name, waypoints, tracks):
         r += f'<name>{escape(t.name)}</name>'
         r += '<trkseg>'
 
-        for c in t.coords:
-            lon = c[0]
-            lat = c[1]
-            r += f'<trkpt lat="{lat}" lon="{lon}">'
-            r += '</trkpt>'
+        if compact:
+            r += ''.join(
+                f'<trkpt lat="{round_coord(c[1], places)}" ' \
+                f'lon="{round_coord(c[0], places)}"/>'
+                for c in t.coords)
+
+        else:
+            for c in t.coords:
+                lon = decimal_text(c[0])
+                lat = decimal_text(c[1])
+                r += f'<trkpt lat="{lat}" lon="{lon}">'
+                r += '</trkpt>'
 
         r += '</trkseg>'
         r += '</trk>'
@@ -79,62 +356,415 @@ def toxml(name, waypoints, tracks):
 
     return r
 
-def sym_normalize(sym, name):
-    placemark2_map = {
-        "restroom|bathroom|washroom|toilet": "restroom",
-        "ranger sta|guard sta": "residence",
-        "Crescent Junction": "pin",  # The town
-        "junction": "junction",
-        "Edwards Crossing": "bridge",  # The bridge
-        "crossing": "crossing",
-        "cemetery|grave": "cemetery",
-        "museum": "museum",
-        "visitors+ center": "museum",
-        "summit": "summit",
-        "hardware|store|market|bi-?mart|fred meyer|walmart|grocer|minimart|albertsons|vons|safeway|merc[ae]ntile|food center|food place|thriftway|foods|winco|rosauers": "shopping",
-        " mine$| mines?|^mining|^mine$|^mines$|mines both sides": "mine",
-        "restarea|rest area": "restarea",
-        "theater": "theater",
-        "bridge": "bridge",
-        "post +office|shipping post|ship it": "postoffice",
-        "laundry|laundromat": "laundry",
-        "wildlife area": "hunting",
-        "^lake | lake$|^lake$": "lake",
-        "auto parts": "carrepair",
-        "u-?haul": "movingvan",
-    }
+def togarmin(name, waypoints, tracks, compact=False, places=DECIMAL_PLACES):
+    """
+    Return GPX string with Garmin symbols only.
+    """
+
+    return toxml(name, waypoints, tracks, compact, places, osmand=False)
+
+def toosmand(name, waypoints, tracks, compact=False, places=DECIMAL_PLACES):
+    """
+    Return GPX string with OsmAnd icon extensions only.
+    """
+
+    return toxml(name, waypoints, tracks, compact, places, garmin=False)
+
+def kml_color(color):
+    """
+    Convert a "#rrggbb" color to KML's "aabbggrr".
+    """
+
+    c = color.lstrip("#").lower()
+
+    return f"ff{c[4:6]}{c[2:4]}{c[0:2]}"
+
+def tokml(name, waypoints, tracks, compact=False, places=DECIMAL_PLACES):
+    """
+    Return KML string of all data.
+
+    Coordinates are always rounded to `places` decimal places.
+    """
+
+    sep = "" if compact else "\n"
+
+    r = '<?xml version="1.0" encoding="UTF-8"?>' \
+        '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>' \
+        f'<name>{escape(name)}</name>{sep}'
 
-    if sym == "placemark2":
-        sym = None
+    for color in sorted(set(w.marker_color for w in waypoints)):
+        r += f'<Style id="wpt{color.lstrip("#")}"><IconStyle>' \
+            f'<color>{kml_color(color)}</color></IconStyle></Style>{sep}'
 
-        for key in placemark2_map:
-            if re.search(key, name, re.I) is not None:
-                sym = placemark2_map[key]
-                break
+    for w in waypoints:
+        r += '<Placemark>'
+        r += f'<name>{escape(w.name)}</name>'
+        cmt = waypoint_comment(w)
+        if cmt is not None:
+            r += f'<description>{escape(cmt)}</description>'
+        r += f'<styleUrl>#wpt{w.marker_color.lstrip("#")}</styleUrl>'
+        r += '<Point><coordinates>' \
+            f'{round_coord(w.lon, places)},{round_coord(w.lat, places)}' \
+            '</coordinates></Point>'
+        r += f'</Placemark>{sep}'
+
+    for t in tracks:
+        r += '<Placemark>'
+        r += f'<name>{escape(t.name)}</name>'
+        r += '<LineString><coordinates>'
+        r += ' '.join(
+            f'{round_coord(c[0], places)},{round_coord(c[1], places)}'
+            for c in t.coords)
+        r += '</coordinates></LineString>'
+        r += f'</Placemark>{sep}'
+
+    r += '</Document></kml>'
+
+    return r
 
-    if sym == "danger" and re.search(r"cemetery|grave", name, re.I) is not None:
-        sym = "cemetery"
+def togeojson(name, waypoints, tracks, compact=False, places=DECIMAL_PLACES):
+    """
+    Return simplified GeoJSON string of all data.
+
+    Only titles, normalized symbols, colors and descriptions are kept,
+    and coordinates are rounded to `places` decimal places with no
+    elevation.
+    """
+
+    # json writes floats with repr(), so stand in strings for the
+    # coordinates and put their round_coord() text back afterwards
+    coord_texts = []
 
-    if sym == "foodservice" and \
-            re.search(r"bar$|pub$|public house|brewpub", name, re.I) is not None:
-        sym = "bar"
+    def coord(x):
+        coord_texts.append(round_coord(x, places))
+
+        return f"\0{len(coord_texts) - 1}"
+
+    features = []
+
+    for w in waypoints:
+        props = {
+            "title": w.name,
+            "marker-symbol": w.sym if w.sym is not None else "pin",
+            "marker-color": w.marker_color,
+        }
+
+        cmt = waypoint_comment(w)
+        if cmt is not None:
+            props["description"] = cmt
+
+        features.append({
+            "type": "Feature",
+            "properties": props,
+            "geometry": {"type": "Point", \
+                "coordinates": [coord(w.lon), coord(w.lat)]},
+        })
 
-    if sym == "foodservice" and re.search(r"pizza", name, re.I) is not None:
-        sym = "pizza"
+    for t in tracks:
+        coords = [[coord(c[0]), coord(c[1])] for c in t.coords]
+
+        features.append({
+            "type": "Feature",
+            "properties": {"title": t.name},
+            "geometry": {"type": "LineString", "coordinates": coords},
+        })
+
+    data = {"type": "FeatureCollection", "name": name, "features": features}
+
+    if compact:
+        text = json.dumps(data, separators=(",", ":"))
+    else:
+        text = json.dumps(data, indent=1)
+
+    return re.sub(r'"\\u0000(\d+)"', \
+        lambda m: coord_texts[int(m.group(1))], text)
+
+# Output target name: (emitter, file name suffix)
+EMITTERS = {
+    "gpx": (toxml, ".gpx"),
+    "garmin": (togarmin, "-garmin.gpx"),
+    "osmand": (toosmand, "-osmand.gpx"),
+    "kml": (tokml, ".kml"),
+    "geojson": (togeojson, ".geojson"),
+}
+
+def waypoints_extent(waypoints, pattern):
+    """
+    Return the extent of the waypoints whose names match the regex, or
+    None if none do.
+    """
+
+    matches = [[w.lon, w.lat] for w in waypoints if pattern.search(w.name)]
+
+    return coords_extent(matches)
+
+def clip_waypoints_tracks(waypoints, tracks, extent):
+    """
+    Return the waypoints and the parts of tracks inside the extent.
+    """
 
-    if sym in ("camping", "campfire") and re.search(r"campsite", name, re.I) is not None:
-        sym = "campsite"
+    waypoints = [w for w in waypoints if point_in_extent(w.lon, w.lat, extent)]
 
-    return sym
+    new_tracks = []
+
+    for t in tracks:
+        pieces = clip_line(t.coords, extent)
+
+        for i, coords in enumerate(pieces):
+            name = t.name if len(pieces) == 1 else f"{t.name}-{i+1}"
+            new_tracks.append(Track(name, coords))
+
+    return waypoints, new_tracks
+
+def track_distances(tracks):
+    """
+    Return a list per track of cumulative route distance in meters at
+    each coordinate.
+
+    A track that starts where the previous one ended (as split tracks
+    do) continues the previous track's distance; otherwise the count
+    starts over at zero.
+    """
+
+    all_dists = []
+    prev = None
+
+    for t in tracks:
+        coords = t.coords
+
+        if prev is not None and coords != [] and prev.coords != [] and \
+                coords[0] == prev.coords[-1]:
+            total = all_dists[-1][-1]
+        else:
+            total = 0
+
+        dists = [total]
+
+        for a, b in zip(coords, coords[1:]):
+            total += lldist(a[1], a[0], b[1], b[0])
+            dists.append(total)
+
+        all_dists.append(dists)
+        prev = t
+
+    return all_dists
+
+def snap_waypoints(waypoints, tracks):
+    """
+    Return for each waypoint (track index, distance along the route,
+    offset from it) for its nearest track segment, or None if there are
+    no tracks.
+    """
+
+    grid = SegmentGrid([t.coords for t in tracks])
+    dists = track_distances(tracks)
+
+    snaps = []
+
+    for w in waypoints:
+        nearest = grid.nearest(w.lon, w.lat)
+
+        if nearest is None:
+            snaps.append(None)
+            continue
+
+        offset, ti, si, frac = nearest
+        d0 = dists[ti][si]
+        d1 = dists[ti][si + 1]
+
+        snaps.append((ti, d0 + frac * (d1 - d0), offset))
+
+    return snaps
+
+def locate_waypoints(waypoints, tracks):
+    """
+    Snap each waypoint to its nearest track segment, recording the
+    distance along the route and the offset from it.
+    """
+
+    for w, snap in zip(waypoints, snap_waypoints(waypoints, tracks)):
+        if snap is not None:
+            w.track_index, w.route_dist, w.route_offset = snap
+
+def pack_fits(part, track_count, waypoint_count, max_tracks, max_waypoints):
+    """
+    Return True if a part, a (waypoints, tracks) pair, has room for
+    that many more tracks and waypoints.
+    """
+
+    waypoints, tracks = part
+
+    return (max_tracks is None or len(tracks) + track_count <= max_tracks) and \
+        (max_waypoints is None or \
+            len(waypoints) + waypoint_count <= max_waypoints)
+
+def pack_stream(units, max_tracks, max_waypoints, keep_units, follow_waypoints):
+    """
+    Pack units, (tracks, waypoints) pairs in route order, into as few
+    (waypoints, tracks) parts as fit the limits, in order.
+
+    Each part is filled before the next is started. If keep_units is
+    set, a unit that won't fit in the current part but would fit in an
+    empty one starts a new part, rather than being split across two.
+    A unit's tracks go in the part the unit starts in or, if
+    follow_waypoints is set, in whichever part with room took the most
+    of its waypoints.
+    """
+
+    parts = [([], [])]
+
+    for unit_tracks, unit_waypoints in units:
+        part = parts[-1]
+
+        if not pack_fits(part, len(unit_tracks), len(unit_waypoints), \
+                max_tracks, max_waypoints):
+
+            if keep_units and part != ([], []) and \
+                    pack_fits(([], []), len(unit_tracks), len(unit_waypoints), \
+                        max_tracks, max_waypoints):
+                parts.append(([], []))
+
+        if not pack_fits(parts[-1], len(unit_tracks), 0, max_tracks, max_waypoints):
+            parts.append(([], []))
+
+        start = len(parts) - 1
+        counts = [0]
+
+        for w in unit_waypoints:
+            if not pack_fits(parts[-1], 0, 1, max_tracks, max_waypoints):
+                parts.append(([], []))
+                counts.append(0)
+
+            parts[-1][0].append(w)
+            counts[-1] += 1
+
+        # The first part has room for them, the new ones have no tracks
+        for t in unit_tracks:
+            room = [i for i in range(len(counts)) \
+                if pack_fits(parts[start + i], 1, 0, max_tracks, max_waypoints)]
+
+            best = max(room, key=lambda i: counts[i]) if follow_waypoints else 0
+            parts[start + best][1].append(t)
+
+    return [p for p in parts if p != ([], [])]
+
+def pack(waypoints, tracks, max_tracks, max_waypoints):
+    """
+    Split waypoints and tracks into as few (waypoints, tracks) parts as
+    fit within max_tracks and max_waypoints per part.
+
+    Each track travels with the waypoints nearest it, in order along
+    the route, and tracks stay in their original order, so each part
+    covers one stretch of the route. Of the ways tried, the one with
+    the fewest parts wins, then the one with the fewest waypoints in a
+    different part from their track.
+
+    Return the parts, and for each part a list of (waypoint, track)
+    pairs for its waypoints packed apart from their track.
+    """
+
+    by_track = [[] for _ in tracks]
+    loose = []
+
+    for w, snap in zip(waypoints, snap_waypoints(waypoints, tracks)):
+        if snap is None:
+            loose.append(w)
+        else:
+            by_track[snap[0]].append((snap[1], w))
+
+    units = []
+
+    for t, track_waypoints in zip(tracks, by_track):
+        track_waypoints.sort(key=lambda x: x[0])
+        units.append(([t], [w for _, w in track_waypoints]))
+
+    if loose != []:
+        units.append(([], loose))
+
+    owner = {w: t for t, track_waypoints in zip(tracks, by_track) \
+        for _, w in track_waypoints}
+
+    def apart_from_track(parts):
+        track_part = {t: i for i, (_, part_tracks) in enumerate(parts) \
+            for t in part_tracks}
+
+        return [[(w, owner[w]) for w in part_waypoints \
+            if w in owner and track_part[owner[w]] != i] \
+            for i, (part_waypoints, _) in enumerate(parts)]
+
+    best = None
+
+    for keep_units in (True, False):
+        for follow_waypoints in (True, False):
+            parts = pack_stream(units, max_tracks, max_waypoints, \
+                keep_units, follow_waypoints)
+            apart = apart_from_track(parts)
+
+            score = (len(parts), sum(len(a) for a in apart))
+
+            if best is None or score < best[0]:
+                best = (score, parts, apart)
+
+    return best[1], best[2]
+
+def output_file_name(out_file_name, targets, target, part, part_count, compress):
+    """
+    Return the file name for one target and part of the output.
+    """
+
+    if out_file_name is None or out_file_name == "-":
+        return out_file_name
+
+    part_suffix = f"-{part}" if part_count > 1 else ""
+
+    if len(targets) > 1:
+        _, suffix = EMITTERS[target]
+
+        name = out_file_name + part_suffix + suffix
+
+        if compress:
+            name += ".gz"
+
+        return name
+
+    root, ext = os.path.splitext(out_file_name)
+
+    if ext == ".gz":
+        root, ext2 = os.path.splitext(root)
+        ext = ext2 + ext
+
+    return root + part_suffix + ext
+
+def waypoint_comment(w):
+    """
+    Return the comment for a waypoint: the description, led by the
+    mile marker if the waypoint has been located on the route.
+    """
+
+    if w.route_dist is None:
+        return w.desc
+
+    marker = f"mi {w.route_dist / M_PER_MILE:.1f}"
+
+    off_mi = w.route_offset / M_PER_MILE
+
+    if off_mi >= OFF_ROUTE_MIN_MI:
+        marker += f", {off_mi:.1f} mi off route"
+
+    if w.desc is None:
+        return marker
+
+    return f"{marker} \u2014 {w.desc}"
 
 def garmin_symbol_map(sym, name, color):
+    """
+    Map a normalized symbol to a Garmin symbol name.
+    """
+
     # All red markers should be red-flagged
     if color == "FF0000" or color == "#FF0000":
         return "Flag, Red"
 
-    sym = sym.split('$')[0]
-    sym = sym_normalize(sym, name)
-
     if sym is None:
         print(f'Unknown name {name} for placemark2', file=sys.stderr)
         sym = "pin"
@@ -211,8 +841,9 @@ def garmin_symbol_map(sym, name, color):
     return sym_map[sym]
 
 def osmand_symbol_map(sym, name, color):
-    sym = sym.split('$')[0]
-    sym = sym_normalize(sym, name)
+    """
+    Map a normalized symbol to an OsmAnd icon and color.
+    """
 
     new_color = "#0000ff"  # blue
 
@@ -289,7 +920,7 @@ def osmand_symbol_map(sym, name, color):
 
     return sym, new_color
 
-def get_waypoints_tracks(jdata):
+def get_waypoints_tracks(jdata, places=DECIMAL_PLACES):
     waypoints = []
     tracks = []
 
@@ -314,8 +945,11 @@ def get_waypoints_tracks(jdata):
             name = f["properties"]["title"]
             color = f["properties"]["marker-color"] if "marker-color" in f["properties"] else "#000000"
 
+            # Classify once and share it with every output target
+            sym = sym_normalize(sym.split('$')[0], name)
+
             garmin_sym = garmin_symbol_map(sym, name, color)
-            osmand_sym, color = osmand_symbol_map(sym, name, color)
+            osmand_sym, osmand_color = osmand_symbol_map(sym, name, color)
 
             if "description" in f["properties"]:
                 desc = f["properties"]["description"]
@@ -323,11 +957,15 @@ def get_waypoints_tracks(jdata):
             else:
                 desc = None
 
-            # Force to 6 or fewer decimal places
+            # Force to `places` or fewer decimal places
             c = f["geometry"]["coordinates"]
-            c = list(map(lambda x: float(f'{x:.6f}'), c))
+            c = list(map(lambda x: float(round_coord(x, places)), c))
 
-            wp = Waypoint(name, c[1], c[0], garmin_sym, osmand_sym, color, desc); # switch to lat,lon
+            # Some exports have "#rrggbb", some "rrggbb", some null
+            marker_color = "#" + (color or "000000").lstrip("#")
+
+            wp = Waypoint(name, c[1], c[0], sym, garmin_sym, osmand_sym, osmand_color,
+                desc, marker_color); # switch to lat,lon
 
             waypoints.append(wp)
 
@@ -341,30 +979,109 @@ def get_waypoints_tracks(jdata):
             
     return waypoints, tracks
 
+def write_output(out_file_name, data, compress=False):
+    """
+    Write the output data to a file or stdout, optionally gzipped.
+    """
+
+    to_stdout = out_file_name is None or out_file_name == "-"
+
+    if compress:
+        data = gzip.compress((data + "\n").encode("utf-8"))
+
+        if to_stdout:
+            sys.stdout.buffer.write(data)
+        else:
+            with open(out_file_name, "wb") as fp:
+                fp.write(data)
+
+    elif to_stdout:
+        print(data)
+
+    else:
+        with open(out_file_name, "w") as fp:
+            print(data, file=fp)
+
 def main(argv):
     """
     Main.
     """
 
-    try:
-        file_name = argv[1]
-        name = argv[2]
-    except:
-        usage()
-        return 1
+    ac = AppContext(argv)
 
-    if file_name == "-":
+    if ac.in_file_name == "-":
         infile = sys.stdin
     else:
-        infile = open(file_name)
+        infile = open(ac.in_file_name)
 
     jdata = json.load(infile)
 
-    waypoints, tracks = get_waypoints_tracks(jdata)
+    waypoints, tracks = get_waypoints_tracks(jdata, ac.decimal_places)
+
+    bbox = ac.bbox
+
+    if ac.bbox_waypoints is not None:
+        bbox = waypoints_extent(waypoints, ac.bbox_waypoints)
+
+        if bbox is None:
+            print(f"no waypoints match {ac.bbox_waypoints.pattern}", \
+                file=sys.stderr)
+            return 4
+
+    # Measure along the whole route, before any clipping; the clipped
+    # waypoints keep their markers
+    if ac.mile_markers:
+        locate_waypoints(waypoints, tracks)
+
+    if bbox is not None:
+        bbox = pad_extent(bbox, ac.bbox_pad)
+        waypoints, tracks = clip_waypoints_tracks(waypoints, tracks, bbox)
+
+    if ac.max_points is not None:
+        for t in tracks:
+            if len(t.coords) > ac.max_points:
+                print(f"{t.name}: {len(t.coords)} points, over the device's " \
+                    f"{ac.max_points}; build with gjretrack.py -m", \
+                    file=sys.stderr)
+
+    if ac.max_tracks is not None or ac.max_waypoints is not None:
+        parts, apart = pack(waypoints, tracks, ac.max_tracks, ac.max_waypoints)
+    else:
+        parts = [(waypoints, tracks)]
+
+    if len(parts) > 1:
+        if ac.out_file_name is None or ac.out_file_name == "-":
+            print(f"packing: needs {len(parts)} files, give a name with -o", \
+                file=sys.stderr)
+            return 1
+
+        for i, (part_waypoints, part_tracks) in enumerate(parts):
+            print(f"packing: part {i+1}: {len(part_tracks)} tracks, " \
+                f"{len(part_waypoints)} waypoints", file=sys.stderr)
+
+            # Waypoints that didn't fit with their track, by track
+            by_track = {}
+
+            for w, t in apart[i]:
+                by_track.setdefault(t, []).append(w.name)
+
+            for t, names in by_track.items():
+                print(f"packing: part {i+1}: {len(names)} waypoints apart " \
+                    f"from {t.name}: {', '.join(names)}", file=sys.stderr)
+
+    for i, (part_waypoints, part_tracks) in enumerate(parts):
+        name = ac.name if len(parts) == 1 else f"{ac.name}-{i+1}"
+
+        for target in ac.targets:
+            emitter, _ = EMITTERS[target]
+
+            out_file_name = output_file_name(ac.out_file_name, ac.targets, \
+                target, i+1, len(parts), ac.gzip)
 
-    xml_data = toxml(name, waypoints, tracks)
+            data = emitter(name, part_waypoints, part_tracks, ac.compact, \
+                ac.decimal_places)
 
-    print(xml_data)
+            write_output(out_file_name, data, ac.gzip)
 
     return 0
 
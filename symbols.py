@@ -0,0 +1,53 @@
+#
+# Marker symbol classification shared by the scripts.
+#
+
+import re
+
+def sym_normalize(sym, name):
+    placemark2_map = {
+        "restroom|bathroom|washroom|toilet": "restroom",
+        "ranger sta|guard sta": "residence",
+        "Crescent Junction": "pin",  # The town
+        "junction": "junction",
+        "Edwards Crossing": "bridge",  # The bridge
+        "crossing": "crossing",
+        "cemetery|grave": "cemetery",
+        "museum": "museum",
+        "visitors+ center": "museum",
+        "summit": "summit",
+        "hardware|store|market|bi-?mart|fred meyer|walmart|grocer|minimart|albertsons|vons|safeway|merc[ae]ntile|food center|food place|thriftway|foods|winco|rosauers": "shopping",
+        " mine$| mines?|^mining|^mine$|^mines$|mines both sides": "mine",
+        "restarea|rest area": "restarea",
+        "theater": "theater",
+        "bridge": "bridge",
+        "post +office|shipping post|ship it": "postoffice",
+        "laundry|laundromat": "laundry",
+        "wildlife area": "hunting",
+        "^lake | lake$|^lake$": "lake",
+        "auto parts": "carrepair",
+        "u-?haul": "movingvan",
+    }
+
+    if sym == "placemark2":
+        sym = None
+
+        for key in placemark2_map:
+            if re.search(key, name, re.I) is not None:
+                sym = placemark2_map[key]
+                break
+
+    if sym == "danger" and re.search(r"cemetery|grave", name, re.I) is not None:
+        sym = "cemetery"
+
+    if sym == "foodservice" and \
+            re.search(r"bar$|pub$|public house|brewpub", name, re.I) is not None:
+        sym = "bar"
+
+    if sym == "foodservice" and re.search(r"pizza", name, re.I) is not None:
+        sym = "pizza"
+
+    if sym in ("camping", "campfire") and re.search(r"campsite", name, re.I) is not None:
+        sym = "campsite"
+
+    return sym